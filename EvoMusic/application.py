@@ -3,6 +3,7 @@ from diffusers.utils.testing_utils import enable_full_determinism
 from tqdm import tqdm
 import wandb
 from EvoMusic.evolution.evolve import MusicEvolver
+from EvoMusic.evolution import _rng
 from EvoMusic.configuration import load_yaml_config
 from EvoMusic.music_generation.generators import EasyRiffPipeline, MusicGenPipeline
 from EvoMusic.usrapprox.utils.user_train_manager import UsersTrainManager
@@ -156,6 +157,8 @@ class EvoMusic:
                 input=generator_input, name=f"{base_name}_{i}", duration=duration
             )
             audio_paths.append(audio_path)
+        # the songs are read by the user model right after
+        self.music_generator.flush()
 
         return audio_paths
 
@@ -289,7 +292,8 @@ if __name__ == "__main__":
     # Set random seed for reproducibility
     seed = 42
     torch.manual_seed(seed)
-    np.random.seed(seed)
+    # numpy and the compiled selection draws of the searcher
+    _rng.seed(seed)
     random.seed(seed)
     torch.cuda.seed_all()
 
@@ -43,6 +43,9 @@ class MusicGeneratorConfig:
     output_dir: str = "output"
     name: str = "default"
     device: str = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype: str = "float32"  # precision of the model weights, can be "float32", "float16" or "bfloat16"
+    compile: bool = False  # compile the model with torch.compile, the first generations are slower while tracing
+    text_cache_size: int = 1024  # number of encoded prompts kept in memory, 0 to disable the cache
     
     def __post_init__(self):
         assert self.input_type in [
@@ -50,6 +53,8 @@ class MusicGeneratorConfig:
             "token_embeddings",
             "embeddings",
         ], "input_type must be either 'text', 'token_embedding' or 'embeddings'"
+        assert self.text_cache_size >= 0, "Text cache size must be greater or equal to 0"
+        assert self.dtype in ["float32", "float16", "bfloat16"], "dtype must be either 'float32', 'float16' or 'bfloat16'"
 
 
 @dataclass
@@ -170,6 +175,10 @@ class LLMConfig:
     temperature: float = 0.7
     model: str = "gpt-4o-mini"
     api_uri: str = "https://api.openai.com/v1/chat/completions"
+    parallel_requests: int = 4  # number of concurrent requests used to generate new prompts
+
+    def __post_init__(self):
+        assert self.parallel_requests > 0, "Number of parallel requests must be greater than 0"
 
 
 @dataclass
@@ -177,6 +186,8 @@ class FitnessConfig:
     mode: str = "user"  # can either be user, music or dynamic
     target_music: str = ""  # path to the target song
     noise_weight: float = 0.25  # weight of the noise in the fitness
+    cache_size: int = 4096  # number of fitness values of already evaluated solutions to remember, 0 to disable. Approximate: the fitness of a solution also depends on the batch it was generated with
+    persistent_cache_path: str = None  # file storing the fitness of evaluated solutions across runs, only for music mode
     
     device: str = (
         "cuda" if torch.cuda.is_available() else "cpu"
@@ -189,6 +200,11 @@ class FitnessConfig:
         
         if self.mode == "music":
             assert os.path.exists(self.target_music), "Target music file does not exist"
+        assert self.cache_size >= 0, "Cache size must be non negative"
+        if self.persistent_cache_path is not None:
+            # in user and dynamic mode the fitness function changes, so stored values would be stale
+            assert self.mode == "music", "Persistent fitness cache is only supported in music mode"
+            self.persistent_cache_path = os.path.expanduser(self.persistent_cache_path)
 
 @dataclass
 class LLMPromptOperator:
@@ -358,6 +374,8 @@ class evoConf:
     )
     duration: int = 5  # duration of the generated music in seconds
     best_duration: int = 10  # duration of the best solution in seconds
+    eval_batch_size: int = None  # number of solutions generated together during evaluation, None for the whole population
+    solution_dtype: str = "float32"  # dtype used to store the solutions when optimizing embeddings, can be "float32" or "bfloat16"
 
     evotorch: dict = field(
         default_factory=dict
@@ -375,7 +393,9 @@ class evoConf:
         assert self.max_seq_len > 0, "Maximum sequence length must be greater than 0"
         assert self.duration > 0, "Duration must be greater than 0"
         assert self.best_duration > 0, "Best duration must be greater than 0"
-        
+        assert self.eval_batch_size is None or self.eval_batch_size > 0, "Evaluation batch size must be greater than 0"
+        assert self.solution_dtype in ["float32", "bfloat16"], "Solution dtype must be either 'float32' or 'bfloat16'"
+
         if self.search.mode in ["LLM evolve", "full LLM"]:
             assert self.LLM is not None, "LLM configuration must be defined when using LLM evolve or full LLM search mode"
 
@@ -0,0 +1,70 @@
+"""
+Random draws used by the prompt searcher for selection, compiled with numba when it is available.
+Numba keeps its own random state apart from numpy's global one, use 'seed' to seed both.
+"""
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, fall back to plain numpy
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+@njit(cache=True)
+def _seed_compiled(s: int):
+    # inside compiled code np.random.seed seeds numba's random state
+    np.random.seed(s)
+
+
+def seed(s: int):
+    """
+    Seed numpy's global random state and the one of the compiled draws, so that seeded runs are reproducible
+    with and without numba.
+
+        Args:
+            s (int): the seed
+    """
+    np.random.seed(s)
+    _seed_compiled(s)
+
+
+@njit(cache=True)
+def weighted_choice_no_replace(logits: np.ndarray, k: int) -> np.ndarray:
+    """
+    Sample k distinct indices with probability proportional to softmax(logits), using the Gumbel-top-k trick.
+
+        Args:
+            logits (np.ndarray): unnormalized log probabilities of each index
+            k (int): number of indices to sample
+        Returns:
+            np.ndarray: the sampled indices, in sampling order
+    """
+    gumbel = -np.log(-np.log(np.random.rand(logits.shape[0])))
+    return np.argsort(-(logits + gumbel))[:k]
+
+
+@njit(cache=True)
+def tournament_idx(n: int, t: int, k: int) -> np.ndarray:
+    """
+    Draw k tournaments of t distinct indices each out of n individuals.
+
+        Args:
+            n (int): number of individuals
+            t (int): size of each tournament
+            k (int): number of tournaments
+        Returns:
+            np.ndarray: the indices of each tournament, of shape (k, t)
+    """
+    out = np.empty((k, t), dtype=np.int64)
+    perm = np.arange(n)
+    for i in range(k):
+        # partial Fisher-Yates shuffle, only the first t positions are needed
+        for j in range(t):
+            r = np.random.randint(j, n)
+            perm[j], perm[r] = perm[r], perm[j]
+            out[i, j] = perm[j]
+    return out
@@ -1,102 +1,88 @@
-from evotorch.algorithms import CMAES, PGPE, XNES, SNES, CEM
-from evotorch.algorithms.ga import Cosyne, GeneticAlgorithm, SteadyStateGA
-from evotorch.operators import OnePointCrossOver, GaussianMutation, CosynePermutation, MultiPointCrossOver, PolynomialMutation, SimulatedBinaryCrossOver, TwoPointCrossOver
+import importlib
+from functools import lru_cache
 
 from EvoMusic.music_generation.generators import MusicGenerator
 from EvoMusic.evolution.searchers import PromptSearcher
-from EvoMusic.evolution.problem import MusicOptimizationProblem
+from EvoMusic.evolution.problem import MusicOptimizationProblem, LLMPromptGenerator
 from EvoMusic.evolution.logger import LivePlotter
+from EvoMusic.evolution import _rng
 from EvoMusic.configuration import evoConf
 
+@lru_cache(maxsize=None)
+def _ga_operator(name: str):
+    """
+    Resolves the evotorch operator class with the given name, importing it only once.
+    """
+    return getattr(importlib.import_module("evotorch.operators"), name)
+
+def _ga_params(problem, config: evoConf):
+    return {
+        "operators": [
+            _ga_operator(operator.name)(problem, **operator.parameters)
+            for operator in config.search.GA_operators
+        ],
+        "elitist": True,
+        "re_evaluate": None,
+    }
+
+# searchers for the embedding optimization: mode -> (module, class, default parameters besides problem and popsize)
+# algorithms are imported lazily, only the selected one is loaded
+_SEARCHERS = {
+    "CMAES": ("evotorch.algorithms", "CMAES", lambda problem, config: {"stdev_init": 1}),
+    "PGPE": ("evotorch.algorithms", "PGPE", lambda problem, config: {
+        "center_learning_rate": 1,
+        "stdev_learning_rate": 1,
+        "stdev_init": 1,
+    }),
+    "XNES": ("evotorch.algorithms", "XNES", lambda problem, config: {"stdev_init": 1}),
+    "SNES": ("evotorch.algorithms", "SNES", lambda problem, config: {"stdev_init": 1}),
+    "CEM": ("evotorch.algorithms", "CEM", lambda problem, config: {
+        "stdev_init": 1,
+        "parenthood_ratio": 0.25,
+    }),
+    "GA": ("evotorch.algorithms.ga", "GeneticAlgorithm", _ga_params),
+}
+
 class MusicEvolver:
     def __init__(self, config: evoConf, music_generator: MusicGenerator):
         self.config = config
         self.music_generator = music_generator
 
-        self.problem = MusicOptimizationProblem(config, music_generator)
+        # a single LLM generator is shared by the problem and the searcher, if the LLM is configured
+        self.LLM_model = LLMPromptGenerator(config.LLM) if config.LLM is not None else None
+        self.problem = MusicOptimizationProblem(config, music_generator, self.LLM_model)
+
+        if music_generator.config.compile:
+            # trace the compiled model with the shapes of the evaluation before the evolution starts
+            print("Warming up the compiled music generator...")
+            music_generator.warmup(
+                self.problem.generation_batch_size,
+                config.duration,
+                config.max_seq_len,
+            )
 
         if self.problem.text_mode:
             # Initialize the custom PromptSearcher optimizer
-            self.optimizer = PromptSearcher(self.problem, config.search, config.LLM)
+            self.optimizer = PromptSearcher(self.problem, config.search)
         else:
             # Initialize the optimizer for embedding optimization
-            if config.search.mode == "CMAES":
-                default={
-                    "problem": self.problem,
-                    "stdev_init": 1,
-                    "popsize": config.search.population_size,
-                }
-                new_params = config.search.evotorch
-                params = {**default, **new_params}
-                self.optimizer = CMAES(**params)
-            elif config.search.mode == "PGPE":
-                default={
-                    "problem": self.problem,
-                    "center_learning_rate": 1,
-                    "stdev_learning_rate": 1,
-                    "stdev_init": 1,
-                    "popsize": config.search.population_size,
-                }
-                new_params = config.search.evotorch
-                params = {**default, **new_params}
-                self.optimizer = PGPE(**params)
-            elif config.search.mode == "XNES":
-                default={
-                    "problem": self.problem,
-                    "stdev_init": 1,
-                    "popsize": config.search.population_size,
-                }
-                new_params = config.search.evotorch
-                params = {**default, **new_params}
-                self.optimizer = XNES(**params)
-            elif config.search.mode == "SNES":
-                default = {
-                    "problem": self.problem,
-                    "popsize": config.search.population_size,
-                    "stdev_init": 1,
-                }
-                new_params = config.search.evotorch
-                params = {**default, **new_params}
-                self.optimizer = SNES(**params)
-            elif config.search.mode == "CEM":
-                default = {
-                    "problem": self.problem,
-                    "popsize": config.search.population_size,
-                    "stdev_init": 1,
-                    "parenthood_ratio": 0.25,
-                }
-                new_params = config.search.evotorch
-                params = {**default, **new_params}
-                self.optimizer = CEM(**params)
-            elif config.search.mode == "GA":
-                operator_constructors = {
-                    "OnePointCrossOver": OnePointCrossOver,
-                    "GaussianMutation": GaussianMutation,
-                    "CosynePermutation": CosynePermutation,
-                    "MultiPointCrossOver": MultiPointCrossOver,
-                    "PolynomialMutation": PolynomialMutation,
-                    "SimulatedBinaryCrossOver": SimulatedBinaryCrossOver,
-                    "TwoPointCrossOver": TwoPointCrossOver,
-                }
-                default = {
-                    "problem": self.problem,
-                    "popsize": config.search.population_size,
-                    "operators": [
-                        operator_constructors[operator.name](self.problem, **operator.parameters)
-                        for operator in config.search.GA_operators
-                    ],
-                    "elitist": True,
-                    "re_evaluate": None
-                }
-                # musicgen std vectors has 18 as mean std and 41 as max
-                new_params = config.search.evotorch
-                self.problem.epoch_pop = 0
-                params = {**default, **new_params}
-                self.optimizer = GeneticAlgorithm(**params)
-            else:
+            if config.search.mode not in _SEARCHERS:
                 raise ValueError(
-                    "Invalid searcher specified. Choose between 'CMAES', 'PGPE', 'XNES', 'SNES', 'CEM'."
+                    f"Invalid searcher specified. Choose between {', '.join(map(repr, _SEARCHERS))}."
                 )
+            module, name, default_params = _SEARCHERS[config.search.mode]
+            searcher = getattr(importlib.import_module(module), name)
+
+            default = {
+                "problem": self.problem,
+                "popsize": config.search.population_size,
+                **default_params(self.problem, config),
+            }
+            if config.search.mode == "GA":
+                # musicgen std vectors has 18 as mean std and 41 as max
+                self.problem.epoch_pop = 0
+            params = {**default, **config.search.evotorch}
+            self.optimizer = searcher(**params)
 
         # Run the evolution strategy
         print("Starting evolution...")
@@ -117,6 +103,12 @@ class MusicEvolver:
             config.logger,
         )
         
+    def close(self):
+        """
+        Releases the resources of the evolution (background threads), to be called once it's no longer used.
+        """
+        self.problem.close()
+
     def evolve(self, n_generations: int=None, user_fitness=None):
         """
         Run the evolution strategy for a specified number of generations
@@ -136,6 +128,8 @@ class MusicEvolver:
         
         if user_fitness:
             self.problem.evaluator.set_user_fitness(user_fitness)
+            # cached fitness values were computed with the previous fitness function
+            self.problem.clear_fitness_cache()
             
         self.optimizer.run(num_generations=n_generations)
         
@@ -174,7 +168,8 @@ if __name__ == "__main__":
     # Set random seed for reproducibility
     seed = 42
     torch.manual_seed(seed)
-    np.random.seed(seed)
+    # numpy and the compiled selection draws of the searcher
+    _rng.seed(seed)
     random.seed(seed)
     torch.cuda.seed_all()
     
@@ -205,6 +200,8 @@ if __name__ == "__main__":
         name="BestSolution", 
         duration=config.evolution.duration
     )
+    evolver.close()
+    music_generator.close()
     print(f"Best solution saved at: {best_audio_path}")
     
     print(f"Best Fitness: {best_fitness}")
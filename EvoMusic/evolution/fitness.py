@@ -1,5 +1,6 @@
 import os
 import torch
+import torch.nn.functional as F
 import torchaudio
 
 from transformers import AutoModel, Wav2Vec2FeatureExtractor
@@ -41,8 +42,9 @@ class MusicScorer:
             assert os.path.exists(
                 self.config.target_music
             ), "Target music does not exist"
-            self.target_music_emb = self.embed_audios([self.config.target_music]).view(
-                1, -1
+            # normalized once and kept on the device, so that the similarity of a batch is a single matmul
+            self.target_music_emb = F.normalize(
+                self.embed_audios([self.config.target_music]).view(1, -1), dim=-1
             )
             
         self.user_fitness = None
@@ -93,6 +95,53 @@ class MusicScorer:
 
         return torch.stack(embeddings)
 
+    def embed_waveforms(self, waveforms: torch.Tensor, sample_rate: int) -> torch.Tensor:
+        """
+        Compute the embedding of in-memory audio without going through the disk.
+        Resampling and the normalization of the feature extractor are done on the device.
+
+        Args:
+            waveforms (torch.Tensor): mono waveforms of shape (n, samples)
+            sample_rate (int): sampling rate of the waveforms
+
+        Returns:
+            torch.Tensor: The embedding of each waveform
+        """
+        waveforms = waveforms.to(self.config.device, dtype=torch.float32)
+        if sample_rate != self.resample_rate:
+            waveforms = torchaudio.functional.resample(
+                waveforms, sample_rate, self.resample_rate
+            )
+
+        # same zero mean unit variance normalization applied by the feature extractor
+        if self.processor.do_normalize:
+            waveforms = (waveforms - waveforms.mean(dim=1, keepdim=True)) / torch.sqrt(
+                waveforms.var(dim=1, unbiased=False, keepdim=True) + 1e-7
+            )
+
+        # the waveforms have the same length, so the whole batch goes through the model at once
+        with torch.no_grad():
+            output = self.music_embedder_model(
+                input_values=waveforms, output_hidden_states=True
+            )
+            # (layers, n, time, emb_size) -> (n, layers, emb_size)
+            embeddings = torch.stack(output.hidden_states).mean(dim=2).transpose(0, 1)
+
+        return embeddings
+
+    def music_similarity(self, music_embs: torch.Tensor) -> torch.Tensor:
+        """
+        Cosine similarity of each music embedding to the target music
+
+        Args:
+            music_embs (torch.Tensor): The embeddings of the music, of shape (n, ...)
+
+        Returns:
+            torch.Tensor: The similarity of each music embedding to the target music
+        """
+        music_embs = F.normalize(music_embs.reshape(len(music_embs), -1), dim=-1)
+        return (music_embs @ self.target_music_emb.T).view(-1)
+
     def measure_audio_artifacts(self, audio_paths: list[str]) -> torch.Tensor:
         """
         Detect and measure audio artifacts in generated music with more granular analysis,
@@ -101,7 +150,23 @@ class MusicScorer:
         Returns a penalty score in [0, 1] for each audio file.
         """
         penalties = []
+        for audio_path in audio_paths:
+            y, sr = librosa.load(audio_path, sr=None, mono=True)
+            penalties.append(self.measure_waveform_artifacts(y, sr))
+
+        return torch.tensor(penalties, dtype=torch.float32)
 
+    def measure_waveform_artifacts(self, y: np.ndarray, sr: int) -> float:
+        """
+        Measure the audio artifacts of a single mono waveform, see 'measure_audio_artifacts'.
+
+        Args:
+            y (np.ndarray): mono waveform
+            sr (int): sampling rate of the waveform
+
+        Returns:
+            float: penalty score in [0, 1]
+        """
         # Hyperparameters and weights (tunable)
         FRAME_SIZE = 1024
         HOP_SIZE = 512
@@ -112,112 +177,106 @@ class MusicScorer:
         w_hf_noise = 0.2
         w_silence = 0.2
 
-        for audio_path in audio_paths:
-            y, sr = librosa.load(audio_path, sr=None, mono=True)
-
-            # -----------------------------------------------------------
-            # 1. Frame-based Analysis
-            # -----------------------------------------------------------
-            # We’ll split the audio into frames for more detailed analysis
-            # so that abrupt events are captured.
-            frames = librosa.util.frame(
-                y, frame_length=FRAME_SIZE, hop_length=HOP_SIZE
-            ).T  # shape: (#frames, FRAME_SIZE)
-
-            # Safeguard: If the audio is shorter than one frame, pad or skip
-            if frames.shape[0] < 1:
-                penalties.append(0.5)  # Arbitrary penalty for very short audio
-                continue
-
-            # -----------------------------------------------------------
-            # 2. Clipping Detection
-            # -----------------------------------------------------------
-            # Count how many samples are near +1.0 or -1.0 in each frame
-            clipping_threshold = 0.99
-            clipping_counts = np.sum(np.abs(frames) > clipping_threshold, axis=1)
-            # Turn into ratio of clipped samples per frame
-            clipping_ratio_per_frame = clipping_counts / FRAME_SIZE
-            # Take average clipping ratio across frames
-            avg_clipping_ratio = np.mean(clipping_ratio_per_frame)
-            # Convert to penalty, capping at 1.0
-            clipping_penalty = np.clip(avg_clipping_ratio * 5.0, 0, 1)
-
-            # -----------------------------------------------------------
-            # 3. DC Offset
-            # -----------------------------------------------------------
-            # DC offset per frame is the mean of each frame
-            dc_offsets = np.mean(frames, axis=1)
-            avg_dc_offset = np.mean(np.abs(dc_offsets))
-            # Convert to penalty (tunable)
-            # The scale factor below is somewhat arbitrary, you can experiment
-            dc_penalty = np.clip(avg_dc_offset * 10.0, 0, 1)
-
-            # -----------------------------------------------------------
-            # 4. High-Frequency Content / Harsh Noise
-            # -----------------------------------------------------------
-            # Compute a short-time Fourier transform or a simple spectrum for each frame.
-            # We'll measure the fraction of energy above a threshold frequency.
-            # For instance, above 8 kHz could be considered "high" for certain musical contexts.
-            # If sr < 16000, adjust accordingly.
-            stft = librosa.stft(y, n_fft=FRAME_SIZE, hop_length=HOP_SIZE, window='hann')
-            magnitude = np.abs(stft)
-            freqs = librosa.fft_frequencies(sr=sr, n_fft=FRAME_SIZE)
-            
-            # define a high-frequency threshold, e.g., 8 kHz
-            hf_threshold = 8000  
-            hf_indices = freqs >= hf_threshold
-
-            # sum energy in high freq bands
-            hf_energy = np.sum(magnitude[hf_indices, :], axis=0)
-            total_energy = np.sum(magnitude, axis=0) + 1e-8  # avoid /0
-            hf_ratio = hf_energy / total_energy
-            # average HF ratio across frames
-            avg_hf_ratio = np.mean(hf_ratio)
-            # turn it into a penalty if it’s abnormally high
-            hf_noise_penalty = np.clip(avg_hf_ratio * 3.0, 0, 1)
-
-            # -----------------------------------------------------------
-            # 5. Spectral Flux for Discontinuity
-            # -----------------------------------------------------------
-            # We still use librosa's onset_strength or compute flux ourselves:
-            flux = librosa.onset.onset_strength(y=y, sr=sr, hop_length=HOP_SIZE)
-            # measure variation in flux
-            flux_std = np.std(flux)
-            flux_mean = np.mean(flux) + 1e-8
-            flux_penalty = np.clip(flux_std / flux_mean, 0, 1)
-
-            # -----------------------------------------------------------
-            # 6. Silence or Prolonged Near-Silence
-            # -----------------------------------------------------------
-            # We'll compute RMS in short frames, check the ratio of near-silence frames
-            rms = librosa.feature.rms(y=y, frame_length=FRAME_SIZE, hop_length=HOP_SIZE)[0]
-            # threshold for near-silence
-            silence_threshold = np.percentile(rms, 10)  # e.g. 10th percentile
-            silent_frames = rms < silence_threshold
-            silence_ratio = np.mean(silent_frames)
-            # turn into penalty, with some cap
-            silence_penalty = np.clip(silence_ratio * 2.0, 0, 1)
-
-            # -----------------------------------------------------------
-            # 7. Combine Penalties
-            # -----------------------------------------------------------
-            # Weighted sum (one of many ways to combine metrics)
-            total_penalty = (
-                w_clipping * clipping_penalty
-                + w_dc_offset * dc_penalty
-                + w_hf_noise * hf_noise_penalty
-                + w_flux * flux_penalty
-                + w_silence * silence_penalty
-                # if you want to incorporate other smaller metrics,
-                # you can place them here under w_misc
-            )
-
-            # Bound the total penalty in [0, 1]
-            total_penalty = np.clip(total_penalty, 0.0, 1.0)
+        # -----------------------------------------------------------
+        # 1. Frame-based Analysis
+        # -----------------------------------------------------------
+        # We’ll split the audio into frames for more detailed analysis
+        # so that abrupt events are captured.
+        frames = librosa.util.frame(
+            y, frame_length=FRAME_SIZE, hop_length=HOP_SIZE
+        ).T  # shape: (#frames, FRAME_SIZE)
+
+        # Safeguard: If the audio is shorter than one frame, pad or skip
+        if frames.shape[0] < 1:
+            return 0.5  # Arbitrary penalty for very short audio
+
+        # -----------------------------------------------------------
+        # 2. Clipping Detection
+        # -----------------------------------------------------------
+        # Count how many samples are near +1.0 or -1.0 in each frame
+        clipping_threshold = 0.99
+        clipping_counts = np.sum(np.abs(frames) > clipping_threshold, axis=1)
+        # Turn into ratio of clipped samples per frame
+        clipping_ratio_per_frame = clipping_counts / FRAME_SIZE
+        # Take average clipping ratio across frames
+        avg_clipping_ratio = np.mean(clipping_ratio_per_frame)
+        # Convert to penalty, capping at 1.0
+        clipping_penalty = np.clip(avg_clipping_ratio * 5.0, 0, 1)
+
+        # -----------------------------------------------------------
+        # 3. DC Offset
+        # -----------------------------------------------------------
+        # DC offset per frame is the mean of each frame
+        dc_offsets = np.mean(frames, axis=1)
+        avg_dc_offset = np.mean(np.abs(dc_offsets))
+        # Convert to penalty (tunable)
+        # The scale factor below is somewhat arbitrary, you can experiment
+        dc_penalty = np.clip(avg_dc_offset * 10.0, 0, 1)
+
+        # -----------------------------------------------------------
+        # 4. High-Frequency Content / Harsh Noise
+        # -----------------------------------------------------------
+        # Compute a short-time Fourier transform or a simple spectrum for each frame.
+        # We'll measure the fraction of energy above a threshold frequency.
+        # For instance, above 8 kHz could be considered "high" for certain musical contexts.
+        # If sr < 16000, adjust accordingly.
+        stft = librosa.stft(y, n_fft=FRAME_SIZE, hop_length=HOP_SIZE, window='hann')
+        magnitude = np.abs(stft)
+        freqs = librosa.fft_frequencies(sr=sr, n_fft=FRAME_SIZE)
+
+        # define a high-frequency threshold, e.g., 8 kHz
+        hf_threshold = 8000  
+        hf_indices = freqs >= hf_threshold
+
+        # sum energy in high freq bands
+        hf_energy = np.sum(magnitude[hf_indices, :], axis=0)
+        total_energy = np.sum(magnitude, axis=0) + 1e-8  # avoid /0
+        hf_ratio = hf_energy / total_energy
+        # average HF ratio across frames
+        avg_hf_ratio = np.mean(hf_ratio)
+        # turn it into a penalty if it’s abnormally high
+        hf_noise_penalty = np.clip(avg_hf_ratio * 3.0, 0, 1)
+
+        # -----------------------------------------------------------
+        # 5. Spectral Flux for Discontinuity
+        # -----------------------------------------------------------
+        # We still use librosa's onset_strength or compute flux ourselves:
+        flux = librosa.onset.onset_strength(y=y, sr=sr, hop_length=HOP_SIZE)
+        # measure variation in flux
+        flux_std = np.std(flux)
+        flux_mean = np.mean(flux) + 1e-8
+        flux_penalty = np.clip(flux_std / flux_mean, 0, 1)
+
+        # -----------------------------------------------------------
+        # 6. Silence or Prolonged Near-Silence
+        # -----------------------------------------------------------
+        # We'll compute RMS in short frames, check the ratio of near-silence frames
+        rms = librosa.feature.rms(y=y, frame_length=FRAME_SIZE, hop_length=HOP_SIZE)[0]
+        # threshold for near-silence
+        silence_threshold = np.percentile(rms, 10)  # e.g. 10th percentile
+        silent_frames = rms < silence_threshold
+        silence_ratio = np.mean(silent_frames)
+        # turn into penalty, with some cap
+        silence_penalty = np.clip(silence_ratio * 2.0, 0, 1)
+
+        # -----------------------------------------------------------
+        # 7. Combine Penalties
+        # -----------------------------------------------------------
+        # Weighted sum (one of many ways to combine metrics)
+        total_penalty = (
+            w_clipping * clipping_penalty
+            + w_dc_offset * dc_penalty
+            + w_hf_noise * hf_noise_penalty
+            + w_flux * flux_penalty
+            + w_silence * silence_penalty
+            # if you want to incorporate other smaller metrics,
+            # you can place them here under w_misc
+        )
 
-            penalties.append(total_penalty)
+        # Bound the total penalty in [0, 1]
+        total_penalty = np.clip(total_penalty, 0.0, 1.0)
 
-        return torch.tensor(penalties, dtype=torch.float32)
+        return float(total_penalty)
 
     def get_user_likeness(self, audio_paths: list[str]):
         """
@@ -229,7 +288,18 @@ class MusicScorer:
         Returns:
             torch.Tensor: The likeness of the user to each audio files
         """
-        music_embs = self.embed_audios(audio_paths)
+        return self.user_likeness_from_embeddings(self.embed_audios(audio_paths))
+
+    def user_likeness_from_embeddings(self, music_embs: torch.Tensor):
+        """
+        Compute the likeness of a user to already embedded music
+
+        Args:
+            music_embs (torch.Tensor): The embeddings of the music to compare
+
+        Returns:
+            torch.Tensor: The likeness of the user to each music embedding
+        """
         music_embs = music_embs.unsqueeze(0)  # shape (1, 1, n, emb_size)
 
         assert self.user_fitness is not None, "User fitness function not set"
@@ -254,8 +324,7 @@ class MusicScorer:
             base = self.get_user_likeness(audio_paths)
 
         elif self.config.mode == "music":
-            music_embs = self.embed_audios(audio_paths).view(len(audio_paths), -1)
-            base = torch.cosine_similarity(music_embs, self.target_music_emb, dim=1)
+            base = self.music_similarity(self.embed_audios(audio_paths))
         
         # 2) Compute artifact penalties (graininess, clipping, etc.).
         penalties = self.measure_audio_artifacts(audio_paths).to(base.device)
@@ -267,6 +336,60 @@ class MusicScorer:
 
         return final_fitness
 
+    def compute_fitness_from_tensor(self, waveforms: torch.Tensor, sample_rate: int):
+        """
+        Compute the fitness of in-memory audio, same as 'compute_fitness' without the disk round-trip
+
+        Args:
+            waveforms (torch.Tensor): mono waveforms of shape (n, samples)
+            sample_rate (int): sampling rate of the waveforms
+
+        Returns:
+            torch.Tensor: The fitness of the waveforms
+        """
+        # 1) Compute base fitness (likeness to user, music, etc.).
+        base = self.base_fitness_from_tensor(waveforms, sample_rate)
+
+        # 2) Compute artifact penalties (graininess, clipping, etc.).
+        penalties = self.waveform_penalties(waveforms.detach().float().cpu().numpy(), sample_rate)
+
+        # 3) Combine base fitness with penalty.
+        return base - self.config.noise_weight * penalties.to(base.device)
+
+    def base_fitness_from_tensor(self, waveforms: torch.Tensor, sample_rate: int):
+        """
+        Compute the fitness of in-memory audio before the artifact penalties, this is the part running on the device
+
+        Args:
+            waveforms (torch.Tensor): mono waveforms of shape (n, samples)
+            sample_rate (int): sampling rate of the waveforms
+
+        Returns:
+            torch.Tensor: The base fitness of the waveforms
+        """
+        music_embs = self.embed_waveforms(waveforms, sample_rate)
+        if self.config.mode == "user" or self.config.mode == "dynamic":
+            return self.user_likeness_from_embeddings(music_embs)
+
+        elif self.config.mode == "music":
+            return self.music_similarity(music_embs)
+
+    def waveform_penalties(self, audio: np.ndarray, sample_rate: int):
+        """
+        Compute the artifact penalties of in-memory audio, this is the part running on the host as librosa works on numpy
+
+        Args:
+            audio (np.ndarray): mono waveforms of shape (n, samples)
+            sample_rate (int): sampling rate of the waveforms
+
+        Returns:
+            torch.Tensor: The penalty of each waveform
+        """
+        return torch.tensor(
+            [self.measure_waveform_artifacts(y, sample_rate) for y in audio],
+            dtype=torch.float32,
+        )
+
 
 if __name__ == "__main__":
     fitness_config = FitnessConfig()
@@ -150,6 +150,7 @@ class LivePlotter(Logger):
         )
         
         if self.config.wandb:
+            self.generator.flush()
             if self.problem.text_mode:
                 wandb.log({"Best Audio": wandb.Audio(best_audio_path, caption=best)})
             else:
@@ -1,28 +1,53 @@
 import random
-from evotorch.core import Problem, Solution
+import hashlib
+import shelve
+import sys
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict
+from evotorch.core import Problem, SolutionBatch
 from EvoMusic.configuration import evoConf, LLMConfig
 from EvoMusic.music_generation.generators import MusicGenerator
 from EvoMusic.evolution.fitness import MusicScorer
 import torch
-import os
 import time
 import requests
 import json
+import orjson
+import asyncio
+import aiohttp
 
 class LLMPromptGenerator():
     def __init__(self, config: LLMConfig):
         self.config = config
+        # keep-alive session, so that the connection to the API is not opened again for each request.
+        # It's created at the first request, as the generator is also built for runs without an LLM configuration
+        self._session = None
+        self._headers_cache = None
 
-    def query_llm(self, prompt: str):
+    def _get_session(self) -> requests.Session:
         """
-        Query the LLM API with the given prompt.
+        Get the keep-alive session used for the synchronous requests, creating it at the first call.
+        """
+        if self._session is None:
+            self._session = requests.Session()
+            self._session.headers.update(self._headers())
+        return self._session
+
+    def _headers(self):
+        """
+        Get the headers of the requests to the LLM API, shared by the synchronous and the asynchronous requests.
+        """
+        if self._headers_cache is None:
+            self._headers_cache = {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {self.config.api_key}",
+            }
+        return self._headers_cache
+
+    def _request(self, prompt: str):
+        """
+        Build the serialized body of a request to the LLM API for the given prompt.
         """
-        # print(f"\t[LLM] sent request to LLM")
-        # print(f"Querying LLM with prompt: '{prompt}'")
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.config.api_key}",
-        }
         data = {
             "model": self.config.model,
             "messages": [
@@ -35,12 +60,18 @@ class LLMPromptGenerator():
             "temperature": self.config.temperature,
             "max_tokens": 5000,
         }
+        return orjson.dumps(data)
+
+    def query_llm(self, prompt: str):
+        """
+        Query the LLM API with the given prompt.
+        """
+        # print(f"\t[LLM] sent request to LLM")
+        # print(f"Querying LLM with prompt: '{prompt}'")
         try:
-            response = requests.post(
-                self.config.api_uri, headers=headers, data=json.dumps(data)
-            )
+            response = self._get_session().post(self.config.api_uri, data=self._request(prompt))
             response.raise_for_status()
-            llm_response = response.json()["choices"][0]["message"]["content"].strip()
+            llm_response = orjson.loads(response.content)["choices"][0]["message"]["content"].strip()
             # print(f"LLM responded with: '{llm_response}'")
             # print(f"\t[LLM] API request successful")
             return llm_response
@@ -49,6 +80,44 @@ class LLMPromptGenerator():
             print(f"\t[LLM] waiting for 5 minutes before retrying...")
             time.sleep(300)
             return ""
+
+    async def aquery_llm(self, session: aiohttp.ClientSession, prompt: str):
+        """
+        Query the LLM API with the given prompt without blocking, see 'query_llm'.
+        """
+        try:
+            async with session.post(self.config.api_uri, data=self._request(prompt)) as response:
+                response.raise_for_status()
+                llm_response = await response.json(loads=orjson.loads)
+                return llm_response["choices"][0]["message"]["content"].strip()
+        except Exception as e:
+            print(f"\t[LLM] API request failed: {e}")
+            print(f"\t[LLM] waiting for 5 minutes before retrying...")
+            await asyncio.sleep(300)
+            return ""
+
+    def query_llm_batch(self, prompts: list[str]):
+        """
+        Query the LLM API with all the given prompts concurrently.
+        
+        Returns:
+            list[str]: the responses of the LLM, in the same order as the prompts
+        """
+        async def gather():
+            # the session is bound to the event loop, so it's shared only by the requests of this batch
+            async with aiohttp.ClientSession(headers=self._headers()) as session:
+                return await asyncio.gather(
+                    *[self.aquery_llm(session, prompt) for prompt in prompts]
+                )
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return list(asyncio.run(gather()))
+
+        # an event loop is already running in this thread (e.g. Jupyter), so the batch gets its own loop in a worker
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return list(executor.submit(lambda: asyncio.run(gather())).result())
         
     def parse_llm_response(self, response: str):
         """
@@ -73,20 +142,22 @@ class LLMPromptGenerator():
     def generate_prompts(self, num_prompts: int):
         prompts = []
         while len(prompts) < num_prompts:
-            answers = self.query_llm(
-                f"Generate {num_prompts-len(prompts)} diverse prompts for generating music, they should span multiple generes, moods, ..."
-            )
+            # split the prompts to generate among concurrent requests
+            missing = num_prompts - len(prompts)
+            n_requests = min(missing, self.config.parallel_requests)
+            counts = [
+                missing // n_requests + (1 if i < missing % n_requests else 0)
+                for i in range(n_requests)
+            ]
+            answers = self.query_llm_batch([
+                f"Generate {count} diverse prompts for generating music, they should span multiple generes, moods, ..."
+                for count in counts
+            ])
 
-            if answers.count("<prompt>") != answers.count("</prompt>"):
-                continue
+            for answer in answers:
+                prompts += self.parse_llm_response(answer)
 
-            for answer in answers.split("</prompt>"):
-                if "<prompt>" in answer:
-                    prompts.append(answer[answer.index("<prompt>") + 8 :].strip())
-                if len(prompts) >= num_prompts:
-                    break
-
-        return prompts
+        return prompts[:num_prompts]
 
 class MusicOptimizationProblem(Problem):
     """
@@ -99,7 +170,15 @@ class MusicOptimizationProblem(Problem):
         self,
         evolutions_config: evoConf,
         music_generator: MusicGenerator,
+        llm: LLMPromptGenerator = None,
     ):
+        """
+        Args:
+            evolutions_config (evoConf): configuration of the evolution
+            music_generator (MusicGenerator): generator used to produce the music of each solution
+            llm (LLMPromptGenerator, optional): LLM used to generate prompts, shared with the searcher. 
+                A new one is created from the configuration if None.
+        """
         self.evo_config = evolutions_config
         self.text_mode = self.evo_config.search.mode in ["full LLM", "LLM evolve"]
         
@@ -109,48 +188,272 @@ class MusicOptimizationProblem(Problem):
             solution_length=
                 None if self.text_mode
                 else self.evo_config.max_seq_len * music_generator.get_embedding_size(),
-            dtype=object if self.text_mode else torch.float32,
+            dtype=object if self.text_mode else getattr(torch, self.evo_config.solution_dtype),
         )
         
         self.evaluator = MusicScorer(self.evo_config.fitness)
         self.music_generator = music_generator
-        self.LLM_model = LLMPromptGenerator(self.evo_config.LLM)
+        if llm is None and self.evo_config.LLM is not None:
+            llm = LLMPromptGenerator(self.evo_config.LLM)
+        self.LLM_model = llm
         
         self.sample_time = 0 # time taken to generate one sample in the population
         self.current_time = 0 # time taken to generate the current population
+        self._last_log_t = 0 # last time the progress bar was printed
+
+        # the artifact penalties of a sub-batch are computed on the host while the next one is generated
+        self._penalty_executor = ThreadPoolExecutor(max_workers=1)
         
         self.generated = 0
         self.total_generated = 0
         
         self.epoch_pop = self.evo_config.search.population_size
+        # number of solutions generated together, the compiled generator is warmed up with this batch size
+        self.generation_batch_size = self.evo_config.eval_batch_size or self.epoch_pop
+
+        # fitness of the already evaluated solutions, indexed by the hash of the solution (LRU ordered).
+        # The value is the one of the first evaluation, see '_evaluate_batch' on why it's only approximate
+        self._fitness_cache: OrderedDict[str, float] = OrderedDict()
+
+        # second tier of the cache stored on disk, shared by the runs with the same fitness function
+        self._persistent_cache = None
+        if self.evo_config.fitness.persistent_cache_path is not None:
+            self._persistent_cache = shelve.open(self.evo_config.fitness.persistent_cache_path)
+            setup = [
+                self.evo_config.fitness.target_music,
+                self.evo_config.fitness.noise_weight,
+                self.evo_config.duration,
+                self.music_generator.config.model,
+                self.music_generator.config.input_type,
+                self.music_generator.config.dtype,
+                # only the diffusion models have a number of inference steps
+                getattr(self.music_generator.config, "inference_steps", None),
+                self.evo_config.solution_dtype,
+                self.text_mode,
+            ]
+            self._cache_namespace = hashlib.blake2b(json.dumps(setup).encode(), digest_size=8).hexdigest()
+
+    def _solution_keys(self, values) -> list[str]:
+        """
+        Computes the key used in the fitness cache for each solution.
+        Embeddings are hashed at half precision so that numerically negligible differences share the same entry.
+
+            Args:
+                values (ObjectArray | torch.Tensor): prompts or flattened embeddings of the solutions
+            Returns:
+                list[str]: the key of each solution
+        """
+        if self.text_mode:
+            data = [prompt.encode() for prompt in values]
+        else:
+            data = [row.tobytes() for row in values.detach().to(torch.float16).cpu().numpy()]
+        return [hashlib.blake2b(d, digest_size=16).hexdigest() for d in data]
+
+    def _cached_fitness(self, key: str):
+        """
+        Looks up the fitness of a solution in the cache, then in the persistent cache if any.
+
+            Returns:
+                float | None: the fitness of the solution, None if it was never evaluated
+        """
+        if key in self._fitness_cache:
+            self._fitness_cache.move_to_end(key)
+            return self._fitness_cache[key]
+
+        if self._persistent_cache is not None:
+            fitness = self._persistent_cache.get(f"{self._cache_namespace}:{key}")
+            if fitness is not None:
+                self._cache_fitness(key, fitness, persist=False)
+            return fitness
+
+        return None
 
-    def _evaluate(self, solution: Solution):
+    def _cache_fitness(self, key: str, fitness: float, persist: bool = True):
         """
-        Objective function that maps solution vectors to prompts or embeddings, generates music,
+        Stores the fitness of a solution in the cache, evicting the least recently used entry when full.
+        The value is also written through to the persistent cache if any.
+        """
+        if persist and self._persistent_cache is not None:
+            self._persistent_cache[f"{self._cache_namespace}:{key}"] = fitness
+
+        if self.evo_config.fitness.cache_size == 0:
+            return
+        self._fitness_cache[key] = fitness
+        self._fitness_cache.move_to_end(key)
+        if len(self._fitness_cache) > self.evo_config.fitness.cache_size:
+            self._fitness_cache.popitem(last=False)
+
+    def close(self):
+        """
+        Stops the background thread computing the artifact penalties and closes the persistent cache,
+        to be called once the evolution is over.
+        """
+        self._penalty_executor.shutdown(wait=True)
+        if self._persistent_cache is not None:
+            self._persistent_cache.close()
+            self._persistent_cache = None
+
+    def clear_fitness_cache(self):
+        """
+        Forgets the cached fitness values, to be called whenever the fitness function changes.
+        The persistent cache is kept, as it's only used when the fitness function is fixed.
+        """
+        self._fitness_cache.clear()
+
+    def _evaluate_batch(self, batch: SolutionBatch):
+        """
+        Objective function that maps the whole batch of solutions to prompts or embeddings, generates music,
         computes embeddings, and evaluates similarity to the target embedding.
+        The generator and the scorer are called once per sub-batch instead of once per solution,
+        solutions already evaluated in the past are read from the fitness cache and
+        duplicated solutions in the batch are evaluated only once.
+
+        The cached fitness is an approximation, not a transparent memoization: the music is sampled
+        with a generator seeded once per sub-batch, so the audio of a solution, and its fitness, also depend
+        on the other solutions generated with it. The cache keeps the value of the first evaluation,
+        and duplicates in a batch share it. Set 'cache_size' to 0 (and no persistent cache) for exact re-evaluation.
         """
-        start_time = time.time()
-        self.generated += 1
-        
-        generator_input = solution.values
-        if not self.text_mode:
-            # copy the input to a new tensor as the values are read-only
-            generator_input = solution.values.clone().detach() 
-        
-        audio_path = self.music_generator.generate_music(input=generator_input, duration=self.evo_config.duration, name=f"music_intermediate")
+        values = batch.values
+        keys = self._solution_keys(values)
+        fitness = [None] * len(batch)
+
+        # solutions already seen skip the generation entirely
+        missing = []
+        for i, key in enumerate(keys):
+            fitness[i] = self._cached_fitness(key)
+            if fitness[i] is None:
+                missing.append(i)
 
-        # Compute the embedding of the generated music
-        fitness = self.evaluator.compute_fitness([audio_path]).squeeze()
+        # duplicated solutions inside the batch are generated only once
+        first_index = {}
+        for i in missing:
+            first_index.setdefault(keys[i], i)
+        unique = list(first_index.values())
 
-        # Clean up generated audio file
-        if os.path.exists(audio_path):
-            os.remove(audio_path)
-            # print(f"Deleted temporary audio file: {audio_path}")
+        def collect(indices: list[int], sub_fitness: Future):
+            nonlocal last_time
+            sub_fitness = sub_fitness.result()
+            now = time.time()
+            self._update_progress(len(indices), sub_fitness, now - last_time)
+            last_time = now
+
+            for i, f in zip(indices, sub_fitness.tolist()):
+                fitness[i] = f
+                self._cache_fitness(keys[i], f)
+
+        # sub-batches are pipelined: the previous one is collected once the next one has been generated
+        pending = None
+        last_time = time.time()
+        batch_size = self.generation_batch_size
+        for start in range(0, len(unique), batch_size):
+            indices = unique[start : start + batch_size]
+            if self.text_mode:
+                sub_values = [values[i] for i in indices]
+            else:
+                sub_values = values[indices]
+
+            sub_fitness = self._evaluate_values(sub_values)
+            if pending is not None:
+                collect(*pending)
+            pending = (indices, sub_fitness)
+        if pending is not None:
+            collect(*pending)
+
+        # fan out the fitness to the duplicates and account for the solutions that were not generated
+        for i in missing:
+            fitness[i] = fitness[first_index[keys[i]]]
+        skipped = len(batch) - len(unique)
+        if skipped > 0:
+            generated = set(unique)
+            skipped_fitness = [f for i, f in enumerate(fitness) if i not in generated]
+            self._update_progress(skipped, torch.tensor(skipped_fitness), 0)
+
+        if self._persistent_cache is not None and unique:
+            self._persistent_cache.sync()
+
+        batch.set_evals(torch.tensor(fitness, dtype=torch.float32))
+
+    def _evaluate_values(self, values):
+        """
+        Generates the music for a slice of the population and computes its fitness.
+        The part of the fitness running on the device is computed right away,
+        the artifact penalties are computed in background on the host.
+
+            Args:
+                values (ObjectArray | torch.Tensor): prompts or flattened embeddings of the solutions
+            Returns:
+                Future[torch.Tensor]: fitness of each solution, on the host
+        """
+        if self.text_mode:
+            generator_input = [prompt for prompt in values]
+        else:
+            # the generators only view and cast their input, so evotorch's read-only wrapper is dropped without a copy
+            generator_input = values.detach().as_subclass(torch.Tensor)
 
-        generation_time = time.time() - start_time
-        if self.sample_time == 0: self.sample_time = generation_time
-        else: self.sample_time = self.sample_time * 0.9 + generation_time * 0.1
+        # the compiled generator is traced for a single batch size, a new size would recompile it in the middle
+        # of the run: smaller sub-batches (cache hits, duplicates, last sub-batch) are padded with their last solution
+        n = len(generator_input)
+        pad = self.generation_batch_size - n
+        if self.music_generator.config.compile and pad > 0:
+            if self.text_mode:
+                generator_input = generator_input + [generator_input[-1]] * pad
+            else:
+                generator_input = torch.cat((generator_input, generator_input[-1:].expand(pad, -1)))
+
+        # keep the generated audio in memory, it goes straight from the generator to the scorer
+        waveforms = self.music_generator.generate_waveform(
+            input=generator_input,
+            duration=self.evo_config.duration,
+            batched=True,
+        )[:n]
+
+        # Compute the fitness of the generated music, the penalties are started on the host first
+        # so that they overlap with the base fitness on the device, even when there is a single sub-batch
+        sampling_rate = self.music_generator.get_sampling_rate()
+        audio = waveforms.detach().float().cpu().numpy()
+        penalties = self._penalty_executor.submit(self.evaluator.waveform_penalties, audio, sampling_rate)
+        base = self.evaluator.base_fitness_from_tensor(waveforms, sampling_rate).view(-1)
+
+        def combine():
+            return base.cpu() - self.evaluator.config.noise_weight * penalties.result()
+
+        # queued after the penalties on the single worker, so it never waits on a task behind it
+        return self._penalty_executor.submit(combine)
+
+    def _update_progress(self, n: int, fitness: torch.Tensor, generation_time: float):
+        """
+        Updates the timing statistics and prints the progress bar of the current population.
+
+            Args:
+                n (int): number of solutions evaluated since the last update
+                fitness (torch.Tensor): fitness of the evaluated solutions
+                generation_time (float): time taken to evaluate the solutions, 0 for cached solutions
+        """
+        self.generated += n
+
+        sample_time = generation_time / n
+        if generation_time == 0: pass # cached solutions do not contribute to the time estimate
+        elif self.sample_time == 0: self.sample_time = sample_time
+        else: self.sample_time = self.sample_time * 0.9 + sample_time * 0.1
         self.current_time += generation_time
+
+        finished = self.generated >= self.epoch_pop and self.epoch_pop > 0
+        # the bar is only drawn on a terminal, at most 4 times per second and always at the end of the population
+        now = time.time()
+        if sys.stdout.isatty() and (finished or now - self._last_log_t > 0.25):
+            self._last_log_t = now
+            self._print_progress(fitness.max().item(), sample_time)
+            
+        if finished:
+            self.generated = 0
+            self.total_generated += self.epoch_pop
+            print(f"\nFinished generation for this population. Total Time: {self.current_time:.2f}s", end="\r")
+            self.current_time = 0
+
+    def _print_progress(self, best_fitness: float, sample_time: float):
+        """
+        Prints the progress bar of the current population.
+        """
         time_left = self.sample_time * (self.epoch_pop - self.generated)
         total_time = self.current_time + time_left
         # make into time format so it's easier to read
@@ -161,24 +464,16 @@ class MusicOptimizationProblem(Problem):
             bar_length = 30
             filled_length = int(bar_length * self.generated // self.epoch_pop)
             bar = "█" * filled_length + "-" * (bar_length - filled_length)
-            print(
+            sys.stdout.write(
                 f"Generated {self.generated}/{self.epoch_pop} |{bar}| "
                 f"{(100 * self.generated / self.epoch_pop):.1f}% "
-                f"~ Fitness {fitness:.2f} "
+                f"~ Best Fitness {best_fitness:.2f} "
                 f"~ Progress {current_time} / {total_time} "
-                f"~ Sample Time {generation_time:.2f}s",
-                end="\r"
+                f"~ Sample Time {sample_time:.2f}s\r"
             )
         else:
-            print(f"Generated {self.generated} | Fitness {fitness:.2f} | Sample Time {generation_time:.2f}s", end="\r")
-            
-        if self.generated >= self.epoch_pop and self.epoch_pop > 0:
-            self.generated = 0
-            self.total_generated += self.epoch_pop
-            print(f"\nFinished generation for this population. Total Time: {self.current_time:.2f}s", end="\r")
-            self.current_time = 0
-
-        solution.set_evals(fitness)
+            sys.stdout.write(f"Generated {self.generated} | Best Fitness {best_fitness:.2f} | Sample Time {sample_time:.2f}s\r")
+        sys.stdout.flush()
 
     def fill_with_LLM(self, population:int):
         """
@@ -187,17 +482,20 @@ class MusicOptimizationProblem(Problem):
             Args:
                 population: int, the size of the population
         """
+        if self.LLM_model is None:
+            raise ValueError("The LLM initialization requires the LLM to be configured")
+
         prompts = []
         processed_prompts = []
         
         while len(processed_prompts) < population:
-            # Generate diverse prompts for the initial population
-            prompts = self.LLM_model.generate_prompts(population)
+            # Generate diverse prompts for the missing part of the population
+            prompts = self.LLM_model.generate_prompts(population - len(processed_prompts))
             
             # if not in text mode, then check if the embeddings are valid
             if not self.text_mode:
-                processed = self.music_generator.preprocess_text(prompts, self.evo_config.max_seq_len)
-                processed = [prompt for prompt in processed if prompt.shape[0] == self.evo_config.max_seq_len]
+                embeds, lengths = self.music_generator.preprocess_text(prompts, self.evo_config.max_seq_len)
+                processed = list(embeds[lengths == self.evo_config.max_seq_len])
             else:
                 processed = prompts
             
@@ -229,8 +527,8 @@ class MusicOptimizationProblem(Problem):
             
             # if not in text mode, then check if the embeddings are valid
             if not self.text_mode:
-                processed = self.music_generator.preprocess_text(prompts, self.evo_config.max_seq_len)
-                processed = [prompt for prompt in processed if prompt.shape[0] == self.evo_config.max_seq_len]
+                embeds, lengths = self.music_generator.preprocess_text(prompts, self.evo_config.max_seq_len)
+                processed = list(embeds[lengths == self.evo_config.max_seq_len])
             else:
                 processed = prompts
                 
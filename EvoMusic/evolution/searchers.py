@@ -1,16 +1,21 @@
 import math
+import random
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from evotorch.algorithms import SearchAlgorithm
 from evotorch.algorithms.searchalgorithm import SinglePopulationAlgorithmMixin
 import torch
-from tqdm import tqdm
 
 from EvoMusic.evolution.problem import MusicOptimizationProblem, LLMPromptGenerator
-from EvoMusic.configuration import LLMConfig, LLMPromptOperator, searchConf
+from EvoMusic.evolution._rng import weighted_choice_no_replace, tournament_idx
+from EvoMusic.configuration import LLMPromptOperator, searchConf
 
 # ------------------------- Evolutionary Algorithm ------------------------
 
+# origin of the individuals of a new population
+ELITE, NOVEL, CHILD = 0, 1, 2
+
 class LLMEvolutionOperator():
     def __init__(self, operator_config: LLMPromptOperator, LLM: LLMPromptGenerator):
         """
@@ -33,30 +38,50 @@ class LLMEvolutionOperator():
             Returns:
                 new_population (list[str]): The evolved population of prompts.
         """
-        assert len(inputs) == self.config.input, f"Input size is not equal to the expected size of {self.config.input}"
-        output = []
-        
-        
-        execute = np.random.rand() < self.config.probability
-        if not execute:
-            # sample from inputs without applying the operator
-            return np.random.choice(inputs, self.config.output, replace=False).tolist()
+        return self.apply_batch([inputs])[0]
+
+    def apply_batch(self, groups: list[list[str]]):
+        """
+            Apply the LLM operator to several groups of prompts, querying the LLM concurrently for all of them.
+            
+            Args:
+                groups (list[list[str]]): The groups of prompts to evolve, each one is an input of the operator.
+                
+            Returns:
+                new_groups (list[list[str]]): The evolved groups of prompts, in the same order as the inputs.
+        """
+        outputs = []
+        pending = []
+        for inputs in groups:
+            assert len(inputs) == self.config.input, f"Input size is not equal to the expected size of {self.config.input}"
+            
+            execute = np.random.rand() < self.config.probability
+            if not execute:
+                # sample from inputs without applying the operator
+                outputs.append(random.sample(list(inputs), self.config.output))
+            else:
+                outputs.append([])
+                pending.append(len(outputs) - 1)
         
         # print(f"\t[LLM evolve] Applying operator {self.config.name}")
         
-        while len(output) < self.config.output:
-            # generate new prompts using LLM
-            prompts = [f"\n{i+1}. {inputs[i]}" for i in range(len(inputs))]
-            LLM_prompt = self.config.prompt.format(prompts=prompts)
+        while pending:
+            # generate new prompts using LLM for all the groups which are not full yet
+            LLM_prompts = []
+            for i in pending:
+                prompts = [f"\n{j+1}. {groups[i][j]}" for j in range(len(groups[i]))]
+                LLM_prompts.append(self.config.prompt.format(prompts=prompts))
             
-            answers = self.LLM_model.query_llm(LLM_prompt)
-            generated_prompts = self.LLM_model.parse_llm_response(answers)
+            answers = self.LLM_model.query_llm_batch(LLM_prompts)
+            for i, answer in zip(pending, answers):
+                generated_prompts = self.LLM_model.parse_llm_response(answer)
+                outputs[i] += generated_prompts[: self.config.output - len(outputs[i])]
             
-            output += generated_prompts[: self.config.output - len(output)]
+            pending = [i for i in pending if len(outputs[i]) < self.config.output]
         
         # print(f"\t[LLM evolve] Operator {self.config.name} applied successfully")
             
-        return output
+        return outputs
 
         
 
@@ -65,19 +90,29 @@ class PromptSearcher(SearchAlgorithm, SinglePopulationAlgorithmMixin):
         self,
         problem: MusicOptimizationProblem,
         search_config: searchConf,
-        LLM_config: LLMConfig,
     ):
         SearchAlgorithm.__init__(self, problem)
 
         self._problem = problem
 
         self.config = search_config
-        self.LLM_model = LLMPromptGenerator(LLM_config)
+        # share the LLM of the problem
+        self.LLM_model = problem.LLM_model
 
         self._population = None
 
         self.generations = 1
         
+        # novel prompts of the next generation are generated in background while the current one is evaluated
+        self._novel_executor = None
+        self._novel_future = None
+        # generations left in the current run, None when the steps are not driven by 'run'
+        self._remaining_steps = None
+        
+        # origin (ELITE, NOVEL or CHILD) and parent indices of each individual, set by the LLM evolve step
+        self.population_source = None
+        self.population_parents = None
+        
         # if using LLM evolve mode, initialize the operators
         if self.config.mode == "LLM evolve":
             self.operators = [
@@ -112,16 +147,20 @@ class PromptSearcher(SearchAlgorithm, SinglePopulationAlgorithmMixin):
         """
         if n == 0: return []
         
-        if sample:
-            # sample the individuals based on their fitness using softmax
-            fitness = fitness.view(-1) / self.config.temperature
-            fitness = torch.softmax(fitness, dim=0)
-            fitness = fitness.cpu().numpy()
-            selected_population = np.random.choice(population, n, p=fitness, replace=False).tolist()
+        if sample and fitness.device.type == "cpu":
+            # sample the individuals based on their softmax fitness with the compiled Gumbel-top-k
+            logits = fitness.view(-1).double().numpy() / self.config.temperature
+            indices = weighted_choice_no_replace(logits, n)
+            selected_population = [population[i] for i in indices.tolist()]
+        elif sample:
+            # sample the individuals based on their fitness using softmax, directly on the device of the fitness
+            probs = torch.softmax(fitness.view(-1) / self.config.temperature, dim=0)
+            indices = torch.multinomial(probs, n, replacement=False)
+            selected_population = [population[i] for i in indices.tolist()]
         else:
             # select the best individuals
-            indices = np.argsort(fitness)
-            selected_population = [population[i] for i in indices[:n]]
+            _, indices = torch.topk(fitness.view(-1), n, largest=True)
+            selected_population = [population[i] for i in indices.tolist()]
         
         return selected_population
 
@@ -143,9 +182,8 @@ class PromptSearcher(SearchAlgorithm, SinglePopulationAlgorithmMixin):
         if self.config.sample:
             elites = self.sample_population(self.population.values, self.population.evals, num_elites, self.config.sample)
         else:
-            indices = self.population.argsort()
-            indices = indices[:num_elites]
-            elites = [self.population[i].values for i in indices]
+            _, indices = torch.topk(self.population.evals.view(-1), num_elites, largest=True)
+            elites = [self.population[i].values for i in indices.tolist()]
             
         return elites
 
@@ -161,6 +199,18 @@ class PromptSearcher(SearchAlgorithm, SinglePopulationAlgorithmMixin):
 
         num_novel = int(self.config.population_size * self.config.novel_prompts)
         
+        if self._novel_future is not None:
+            # prompts requested during the evaluation of the previous generation
+            novel_prompts = self._novel_future.result()
+            self._novel_future = None
+            return novel_prompts
+
+        return self._generate_novel_prompts(num_novel)
+
+    def _generate_novel_prompts(self, num_novel: int) -> list[str]:
+        """
+        Generate the given number of novel prompts with the initialization method of the problem.
+        """
         if self.problem.evo_config.initialization == "LLM":
             novel_prompts = self.problem.fill_with_LLM(num_novel)
         elif self.problem.evo_config.initialization == "file":
@@ -171,10 +221,12 @@ class PromptSearcher(SearchAlgorithm, SinglePopulationAlgorithmMixin):
         return novel_prompts
 
     def full_LLM_step(self):
-        indices = self.population.argsort()
+        # the ranking lists the whole population, so the top-k spans all of it and its first entry is the best
+        evals = self.population.evals.view(-1)
+        indices = torch.topk(evals, len(evals), largest=True).indices.tolist()
         best_idx = indices[0]
         pop_values = self.population.values
-        pop_evals = [self.population[i].evals.item() for i in range(len(indices))]
+        pop_evals = evals.tolist()
 
         ranking = ""
         for i in indices:
@@ -220,39 +272,92 @@ class PromptSearcher(SearchAlgorithm, SinglePopulationAlgorithmMixin):
             Returns:
                 selected_population (list[str]): The selected population of prompts.
         """
+        return [population[i] for i in self.tournament_indices(len(population), fitness, n)]
+
+    def tournament_indices(self, population_size: int, fitness: torch.Tensor, n: int):
+        """
+            Perform tournament selection and return the indices of the selected individuals, see 'tournament_selection'.
+        """
         # randomly select individuals for the tournament
-        selected_idx = np.random.choice(len(population), self.config.tournament_size, replace=False)
-        selected_population = [population[i] for i in selected_idx]
+        if fitness.device.type == "cpu":
+            tournament_size = min(self.config.tournament_size, population_size)
+            selected_idx = torch.from_numpy(tournament_idx(population_size, tournament_size, 1)[0])
+        else:
+            selected_idx = torch.randperm(population_size, device=fitness.device)[: self.config.tournament_size]
         selected_fitness = fitness[selected_idx]
         
         # sample the input individuals based on their fitness
-        selected_population = self.sample_population(selected_population, selected_fitness, n, self.config.sample)
-        
-        return selected_population
+        return self.sample_population(selected_idx.tolist(), selected_fitness, n, self.config.sample)
 
     def LLM_evolve_step(self):
         """
         Evolve the population using the LLM genetic operators.
         Apply the operators until the population is full.
+        The origin of each new individual is kept in 'population_source' and 'population_parents'.
         """
-        new_population = self.get_elites()
-        new_population += self.get_novel_prompts()
+        population_size = self.config.population_size
+        n_parents = self.config.LLM_genetic_operators[0].input
+        
+        # the new population is filled in place, with one array per attribute of the individuals
+        new_population = np.empty(population_size, dtype=object)
+        source = np.full(population_size, CHILD, dtype=np.int8)
+        parent_ids = np.full((population_size, n_parents), -1, dtype=np.int64)
+        fill = 0
+        
+        for prompts, origin in ((self.get_elites(), ELITE), (self.get_novel_prompts(), NOVEL)):
+            new_population[fill : fill + len(prompts)] = prompts
+            source[fill : fill + len(prompts)] = origin
+            fill += len(prompts)
         
         old_population = self.population.values
         old_pop_evals = self.population.evals
         
         print("[LLM evolve] Applying genetic operators...")
-        for _ in tqdm(range(math.ceil((self.config.population_size-len(new_population)) / self.config.LLM_genetic_operators[-1].output))):
-            # select the individuals for the tournament
-            selected_population = self.tournament_selection(old_population, old_pop_evals, self.config.LLM_genetic_operators[0].input)
-            
-            # apply the operators
-            for operator in self.operators:
-                selected_population = operator.apply(selected_population)
-            
-            new_population += selected_population[: self.config.population_size - len(new_population)]
-            
-        self._population.set_values(new_population)
+        # select the individuals for all the tournaments first, so that each operator queries the LLM once for all of them
+        n_tournaments = math.ceil((population_size - fill) / self.config.LLM_genetic_operators[-1].output)
+        parents = [
+            self.tournament_indices(len(old_population), old_pop_evals, n_parents)
+            for _ in range(n_tournaments)
+        ]
+        groups = [[old_population[i] for i in group] for group in parents]
+        
+        # apply the operators
+        for operator in self.operators:
+            groups = operator.apply_batch(groups)
+        
+        for children, group in zip(groups, parents):
+            children = children[: population_size - fill]
+            new_population[fill : fill + len(children)] = children
+            parent_ids[fill : fill + len(children)] = group
+            fill += len(children)
+        
+        self.population_source = source
+        self.population_parents = parent_ids
+        self._population.set_values(new_population.tolist())
+
+    def run(self, num_generations: int, **kwargs):
+        """
+        Run the search for the given number of generations, see 'SearchAlgorithm.run'.
+        The novel prompts are not requested in background for the last generation,
+        and any pending request is dropped when the search ends.
+        """
+        self._remaining_steps = num_generations
+        try:
+            super().run(num_generations, **kwargs)
+        finally:
+            self._remaining_steps = None
+            self._cancel_novel_prompts()
+
+    def _cancel_novel_prompts(self):
+        """
+        Drop the novel prompts being generated in background, without waiting for the LLM.
+        """
+        if self._novel_future is not None:
+            self._novel_future.cancel()
+            self._novel_future = None
+        if self._novel_executor is not None:
+            self._novel_executor.shutdown(wait=False, cancel_futures=True)
+            self._novel_executor = None
 
     def _step(self):
         """Perform a step of the solver"""
@@ -269,4 +374,15 @@ class PromptSearcher(SearchAlgorithm, SinglePopulationAlgorithmMixin):
         # print new population
         # print("Current Population:\n\t- ", "\n\t- ".join(self._population.values))
         
+        if self._remaining_steps is not None:
+            self._remaining_steps -= 1
+        
+        # start generating the novel prompts for the next generation, overlapping with the evaluation
+        num_novel = int(self.config.population_size * self.config.novel_prompts)
+        next_generation = self._remaining_steps is None or self._remaining_steps > 0
+        if num_novel > 0 and self._novel_future is None and next_generation:
+            if self._novel_executor is None:
+                self._novel_executor = ThreadPoolExecutor(max_workers=1)
+            self._novel_future = self._novel_executor.submit(self._generate_novel_prompts, num_novel)
+        
         self._problem.evaluate(self.population)
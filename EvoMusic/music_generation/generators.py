@@ -3,8 +3,14 @@ import os
 import scipy
 import torch
 import copy
+import hashlib
+import itertools
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Union
 from diffusers import DiffusionPipeline
+from diffusers.models.attention_processor import AttnProcessor2_0
 from transformers import AutoProcessor, MusicgenForConditionalGeneration, set_seed
 
 from diffusers.utils.testing_utils import enable_full_determinism
@@ -14,8 +20,20 @@ from riffusion.spectrogram_image_converter import SpectrogramImageConverter
 from riffusion.spectrogram_params import SpectrogramParams
 
 
-def dummy_safety_checker(images, **kwargs):
-    return images, [False] * len(images)
+# prompts are padded to a multiple of this length when the text encoder is compiled
+TEXT_BUCKET = 32
+
+
+def riffusion_width(duration: float) -> int:
+    """
+    Width in pixels of the Riffusion spectrogram for the given duration, 512 pixels every 5 seconds.
+    It is rounded up to a multiple of 8, as required by the VAE of the diffusion model.
+        Args:
+            duration (float): duration in seconds of the generated audio
+        Returns:
+            int: width of the spectrogram
+    """
+    return (math.ceil(duration * 512 / 5) + 7) // 8 * 8
 
 
 class MusicGenerator:
@@ -26,6 +44,13 @@ class MusicGenerator:
     def __init__(self, music_generator: c.MusicGeneratorConfig):
         super().__init__()
         self.config = music_generator
+        # encoded prompts indexed by the hash of the encoding and the prompt (LRU ordered)
+        self._text_enc_cache: OrderedDict[str, torch.Tensor] = OrderedDict()
+        # index of the next generated file, started from the files already in the output directory
+        self._file_counter = None
+        # audio files are written by a background thread, so that the next generation can start meanwhile
+        self._io_pool = ThreadPoolExecutor(max_workers=1)
+        self._pending_writes: list[Future] = []
 
     def token_to_text(self, token_embs: torch.Tensor):
         """
@@ -42,7 +67,7 @@ class MusicGenerator:
         Takes text and returns the embeddings for the model
 
             Args:
-                text (str): text input
+                text (str | list[str]): text input, a list of prompts is encoded with a single forward pass
                 max_length (int, optional): max length of the generated sequence. Defaults to None.
         """
         raise NotImplementedError
@@ -62,7 +87,7 @@ class MusicGenerator:
         Takes text and returns the embeddings before the encoder of the model.
         These are usually the token_embeddings from the tokenizer and the first embedding layer of the model.
             Args:
-                text (str): text input
+                text (str | list[str]): text input, a list of prompts is encoded with a single forward pass
                 max_length (int, optional): max length of the generated sequence. Defaults to None.
             Returns:
                 torch.Tensor: embeddings before the encoder
@@ -78,19 +103,69 @@ class MusicGenerator:
         raise NotImplementedError
 
     def generate_music(
-        self, input: Union[torch.Tensor, str], duration: int, name: str = None, **kwargs
+        self,
+        input: Union[torch.Tensor, str, list[str]],
+        duration: int,
+        name: str = None,
+        batched: bool = False,
+        **kwargs,
     ):
         """
         Generates music from the input
             Args:
-                input (str | torch.Tensor): input for the model
+                input (str | list[str] | torch.Tensor): input for the model
                 duration (int): duration in seconds of the generated audio
                 name (str, optional): name of the generated audio
+                batched (bool, optional): whether the input is a batch of inputs (list of prompts or tensor
+                    with the batch as first dimension) to be generated together. Defaults to False.
             Returns:
-                str: system path to the generated audio
+                str | list[str]: system path to the generated audio, one per input when batched.
+                    The files are written in background, call 'flush' before reading them.
+        """
+        raise NotImplementedError
+
+    def generate_waveform(
+        self,
+        input: Union[torch.Tensor, str, list[str]],
+        duration: int,
+        batched: bool = True,
+        **kwargs,
+    ):
+        """
+        Generates music from the input and returns the raw waveforms without saving them to disk
+            Args:
+                input (str | list[str] | torch.Tensor): input for the model
+                duration (int): duration in seconds of the generated audio
+                batched (bool, optional): whether the input is a batch of inputs. Defaults to True.
+            Returns:
+                torch.Tensor: mono waveforms of shape (batch, samples) on the device of the model,
+                    sampled at 'get_sampling_rate()'
+        """
+        raise NotImplementedError
+
+    def get_sampling_rate(self):
+        """
+        Returns the sampling rate of the audio generated by the model
+            Returns:
+                int: sampling rate in Hz
         """
         raise NotImplementedError
 
+    def warmup(self, batch_size: int, duration: int, max_length: int = None):
+        """
+        Runs a generation on dummy inputs with the shapes used during the evolution,
+        so that compiled models are traced before the first generation.
+            Args:
+                batch_size (int): number of inputs generated together
+                duration (int): duration in seconds of the generated audio
+                max_length (int, optional): length of the embeddings when the input is not text. Defaults to None.
+        """
+        if self.config.input_type == "text":
+            inputs = ["warmup"] * batch_size
+        else:
+            inputs = torch.zeros(batch_size, max_length, self.get_embedding_size())
+        self.generate_waveform(inputs, duration, batched=True)
+
     def prepare_inputs(self, text: str, max_length: int = None):
         """
         Prepares the inputs for the 'transform_inputs' function
@@ -104,11 +179,12 @@ class MusicGenerator:
         """
         raise NotImplementedError
 
-    def transform_inputs(self, inputs: Union[str, torch.Tensor]):
+    def transform_inputs(self, inputs: Union[str, list[str], torch.Tensor], batched: bool = False):
         """
         Transforms the inputs to the embeddings that can be used by the model
             Args:
-                inputs (str | torch.Tensor): inputs to be transformed
+                inputs (str | list[str] | torch.Tensor): inputs to be transformed
+                batched (bool, optional): whether the inputs are a batch of inputs. Defaults to False.
             Returns:
                 torch.Tensor: embeddings for the model
         """
@@ -121,48 +197,186 @@ class MusicGenerator:
                 text (list[str]): text input
                 max_length (int, optional): max length of the generated sequence. Defaults to None.
             Returns:
-                str|torch.Tensor: processed text
+                list[str]|tuple[torch.Tensor, torch.Tensor]: processed text, for embeddings the padded
+                    embeddings of shape (n, length, emb_size) and the actual length of each one
         """
         if self.config.input_type == "text":
             return text
-        elif self.config.input_type == "token_embeddings":
-            return [
-                self.text_to_embeddings_before_encoder(t, max_length).squeeze(0)
-                for t in text
-            ]
-        elif self.config.input_type == "embeddings":
-            return [
-                self.text_to_embed(t, max_length).last_hidden_state.squeeze(0)
-                for t in text
-            ]
+
+        # the prompts missing from the cache go through the encoder together
+        encoded = self.encode_prompts_cached(text, self.config.input_type, max_length)
+        embeds = torch.nn.utils.rnn.pad_sequence(encoded, batch_first=True)
+        lengths = torch.tensor([e.shape[0] for e in encoded], device=embeds.device)
+        return embeds, lengths
+
+    def encode_prompts(self, texts: list[str], input_type: str, max_length: int = None):
+        """
+        Encodes a batch of prompts with a single forward pass, without tracking gradients.
+            Args:
+                texts (list[str]): text inputs
+                input_type (str): "embeddings" for the output of the text encoder,
+                    "token_embeddings" for the embeddings before the encoder
+                max_length (int, optional): max length of the generated sequence. Defaults to None.
+            Returns:
+                list[torch.Tensor]: encoding of each prompt without the padding of the batch,
+                    of shape (length, emb_size)
+        """
+        raise NotImplementedError
+
+    def encode_prompts_cached(self, texts: list[str], input_type: str, max_length: int = None):
+        """
+        Cached version of 'encode_prompts', every encoding of a prompt is stored under the same key
+        whichever path requested it, so that the cache holds a single copy of it.
+            Args:
+                texts (list[str]): text inputs
+                input_type (str): "embeddings" or "token_embeddings", see 'encode_prompts'
+                max_length (int, optional): max length of the generated sequence. Defaults to None.
+            Returns:
+                list[torch.Tensor]: encoding of each prompt, of shape (length, emb_size)
+        """
+        return self.encode_texts_cached(
+            texts, f"{input_type}_{max_length}", lambda t: self.encode_prompts(t, input_type, max_length)
+        )
+
+    def encode_text_cached(self, text: str, encoding: str, encode):
+        """
+        Encodes the text, reusing the result of previous calls with the same prompt and encoding,
+        so that prompts surviving across generations are tokenized and encoded only once.
+            Args:
+                text (str): text input
+                encoding (str): name of the encoding, including the parameters it depends on
+                encode (Callable[[str], Any]): function encoding the text on a miss, without tracking gradients
+            Returns:
+                Any: encoded text
+        """
+        if self.config.text_cache_size == 0:
+            return encode(text)
+
+        key = hashlib.blake2b(f"{encoding}|{text}".encode(), digest_size=16).hexdigest()
+        if key in self._text_enc_cache:
+            self._text_enc_cache.move_to_end(key)
+            return self._text_enc_cache[key]
+
+        encoded = encode(text)
+        self._text_enc_cache[key] = encoded
+        if len(self._text_enc_cache) > self.config.text_cache_size:
+            self._text_enc_cache.popitem(last=False)
+        return encoded
+
+    def encode_texts_cached(self, texts: list[str], encoding: str, encode_batch):
+        """
+        Batched version of 'encode_text_cached', the prompts missing from the cache are encoded together
+        with a single call to the encoder.
+            Args:
+                texts (list[str]): text inputs
+                encoding (str): name of the encoding, including the parameters it depends on
+                encode_batch (Callable[[list[str]], Sequence[Any]]): function encoding a list of prompts on a miss,
+                    returning one encoding per prompt, without tracking gradients
+            Returns:
+                list[Any]: encoded texts, in the same order as the inputs
+        """
+        if self.config.text_cache_size == 0:
+            return list(encode_batch(texts))
+
+        keys = [hashlib.blake2b(f"{encoding}|{t}".encode(), digest_size=16).hexdigest() for t in texts]
+        encoded = {}
+        for key in keys:
+            if key in self._text_enc_cache:
+                self._text_enc_cache.move_to_end(key)
+                encoded[key] = self._text_enc_cache[key]
+
+        # repeated prompts in the batch are encoded once
+        misses = {key: t for key, t in zip(keys, texts) if key not in encoded}
+        if misses:
+            for key, e in zip(misses, encode_batch(list(misses.values()))):
+                encoded[key] = e
+                self._text_enc_cache[key] = e
+            while len(self._text_enc_cache) > self.config.text_cache_size:
+                self._text_enc_cache.popitem(last=False)
+        return [encoded[key] for key in keys]
+
+    def write_async(self, write, *args, **kwargs):
+        """
+        Schedules the writing of an audio file on the background writer thread.
+        Use 'flush' before reading the written files.
+            Args:
+                write (callable): function writing the file
+                *args, **kwargs: arguments of the function
+        """
+        self._pending_writes = [f for f in self._pending_writes if not f.done()]
+        self._pending_writes.append(self._io_pool.submit(write, *args, **kwargs))
+
+    def flush(self):
+        """
+        Waits until all the scheduled audio files are written, raising the error of the first failed write if any.
+        """
+        pending, self._pending_writes = self._pending_writes, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        """
+        Writes the scheduled audio files and stops the background writer thread.
+        """
+        self.flush()
+        self._io_pool.shutdown(wait=True)
 
     def generate_path(self, name=None):
         """
         Generates the path for the output audio, if name is None, it will use jut the default experiment name
-        The number is given based on the number of files in the output directory.
+        The number starts from the number of files in the output directory and is incremented at each call.
             Args:
                 name (str, optional): name of the file. Defaults to None.
             Returns:
                 str: system path to the generated audio
         """
-        # check if the output directory exists
-        if not os.path.exists(self.config.output_dir):
-            os.makedirs(self.config.output_dir)
+        if self._file_counter is None:
+            # check if the output directory exists
+            if not os.path.exists(self.config.output_dir):
+                os.makedirs(self.config.output_dir)
+            # the directory is listed only once, the following files are numbered by the counter
+            self._file_counter = itertools.count(len(os.listdir(self.config.output_dir)))
 
         base_name = self.config.name if name is None else name + "_" + self.config.name
         return os.path.join(
             self.config.output_dir,
-            f"{base_name + '_' + str(len(os.listdir(self.config.output_dir)))}.wav",
+            f"{base_name + '_' + str(next(self._file_counter))}.wav",
         )
 
 
 class EasyRiffPipeline(MusicGenerator):
     def __init__(self, riffusion_config: c.EasyRiffusionConfig):
         super().__init__(riffusion_config)
-        self.model = DiffusionPipeline.from_pretrained(self.config.model).to(
-            self.config.device
-        )
-        self.model.safety_checker = dummy_safety_checker
+        # the spectrograms are not checked for nsfw content, the safety checker is not even loaded
+        self.model = DiffusionPipeline.from_pretrained(
+            self.config.model,
+            torch_dtype=getattr(torch, self.config.dtype),
+            safety_checker=None,
+            requires_safety_checker=False,
+        ).to(self.config.device)
+        # NHWC layout, preferred by the tensor core convolution kernels of cuDNN
+        self.model.unet.to(memory_format=torch.channels_last)
+        self.model.vae.to(memory_format=torch.channels_last)
+        if not torch.are_deterministic_algorithms_enabled():
+            # the spectrograms always have the same shape for a given duration, let cuDNN pick the fastest kernels
+            torch.backends.cudnn.benchmark = True
+        # fused attention kernels (flash / memory efficient) through torch's scaled_dot_product_attention
+        self.model.unet.set_attn_processor(AttnProcessor2_0())
+        # q, k and v of each attention block are projected with a single matmul
+        self.model.fuse_qkv_projections()
+        # the converter builds the mel filter banks once, it's reused by every generation
+        self._params = SpectrogramParams()
+        self._converter = SpectrogramImageConverter(params=self._params)
+        if self.config.compile:
+            # the unet runs once per inference step, it's where compilation pays off
+            self.model.unet = torch.compile(self.model.unet, mode="reduce-overhead")
+        # the conversion of the inputs depends only on the input type, it's selected once
+        self._emb_size = self.get_embedding_size()
+        self._transform = {
+            "text": self._embed_text,
+            "token_embeddings": lambda i, batched: self.token_embedding_to_embed(i),
+            "embeddings": lambda i, batched: i,
+        }[self.config.input_type]
 
     def text_to_embed(self, text, max_length=None):
         inputs = self.prepare_inputs(text, max_length)
@@ -189,6 +403,15 @@ class EasyRiffPipeline(MusicGenerator):
     def get_embedding_size(self):
         return self.model.text_encoder.text_model.config.hidden_size
 
+    def encode_prompts(self, texts, input_type, max_length=None):
+        # the tokenizer pads every prompt to max_length, so the rows are already the encodings of each prompt
+        if input_type == "embeddings":
+            encoded = self.text_to_embed(texts, max_length)
+        else:
+            encoded = self.text_to_embeddings_before_encoder(texts, max_length)
+        # the rows are copied, so that a cached prompt does not keep the whole batch alive
+        return [e.clone() for e in encoded]
+
     def __call__(self, *args, **kwargs):
         return self.model(*args, **kwargs)
 
@@ -207,43 +430,69 @@ class EasyRiffPipeline(MusicGenerator):
                 inputs[key] = inputs[key].to(self.model.device)
         return inputs
 
-    def transform_inputs(self, inputs):
-        emb_size = self.get_embedding_size()
+    def transform_inputs(self, inputs, batched=False):
         if isinstance(inputs, torch.Tensor):
-            i = inputs.view(1, -1, emb_size).to(device=self.model.device)
+            batch_size = inputs.shape[0] if batched else 1
+            # solutions may be stored with a lower precision than the model
+            i = inputs.view(batch_size, -1, self._emb_size).to(device=self.model.device, dtype=self.model.dtype)
         else:
-            i = inputs
+            i = list(inputs) if batched else inputs
+        return self._transform(i, batched)
 
-        if self.config.input_type == "text":
-            return self.text_to_embed(i)
-        elif self.config.input_type == "token_embeddings":
-            return self.token_embedding_to_embed(i)
-        elif self.config.input_type == "embeddings":
-            return i
-        else:
-            raise ValueError(
-                "input_type must be either 'text', 'token_embedding', or 'embeddings'"
-            )
+    def _embed_text(self, text, batched):
+        if not batched:
+            return self.text_to_embed(text)
+        # encode each prompt once, elites are evaluated again in the next generations,
+        # the new prompts of the batch go through the text encoder together
+        return torch.stack(self.encode_prompts_cached(text, "embeddings"))
 
-    def generate_music(self, input, duration=5, name=None, **kwargs):
-        embeddings = self.transform_inputs(input)
-        width = math.ceil(duration * (512 / 5))
+    def generate_segments(self, input, duration=5, batched=False, **kwargs):
+        """
+        Runs the diffusion model and converts the spectrograms to audio segments
+            Args:
+                input (str | list[str] | torch.Tensor): input for the model
+                duration (int): duration in seconds of the generated audio
+                batched (bool, optional): whether the input is a batch of inputs. Defaults to False.
+            Returns:
+                list[pydub.AudioSegment]: generated audio segments, one per input
+        """
+        embeddings = self.transform_inputs(input, batched)
+        width = riffusion_width(duration)
         generator = torch.Generator(device=self.model.device)
         generator.manual_seed(0)
-        output = self.model(
-            prompt_embeds=embeddings,
-            generator=generator,
-            num_inference_steps=self.config.inference_steps,
-            width=width,
-            **kwargs,
-        )
-        audio_path = self.generate_path(name)
-        image = output.images[0]
-        params = SpectrogramParams()
-        converter = SpectrogramImageConverter(params=params)
-        segment = converter.audio_from_spectrogram_image(image, apply_filters=True)
-        segment.export(audio_path, format="wav")
-        return audio_path
+        with torch.inference_mode():
+            output = self.model(
+                prompt_embeds=embeddings,
+                generator=generator,
+                num_inference_steps=self.config.inference_steps,
+                width=width,
+                **kwargs,
+            )
+        return [
+            self._converter.audio_from_spectrogram_image(image, apply_filters=True)
+            for image in output.images
+        ]
+
+    def generate_music(self, input, duration=5, name=None, batched=False, **kwargs):
+        audio_paths = []
+        for segment in self.generate_segments(input, duration, batched, **kwargs):
+            audio_path = self.generate_path(name)
+            self.write_async(segment.export, audio_path, format="wav")
+            audio_paths.append(audio_path)
+        return audio_paths if batched else audio_paths[0]
+
+    def generate_waveform(self, input, duration=5, batched=True, **kwargs):
+        waveforms = []
+        for segment in self.generate_segments(input, duration, batched, **kwargs):
+            samples = np.array(segment.get_array_of_samples(), dtype=np.float32)
+            # de-interleave the channels, downmix to mono and scale the integer samples to [-1, 1]
+            samples = samples.reshape(-1, segment.channels).mean(axis=1)
+            samples /= 1 << (8 * segment.sample_width - 1)
+            waveforms.append(torch.from_numpy(samples))
+        return torch.stack(waveforms).to(self.model.device)
+
+    def get_sampling_rate(self):
+        return self._params.sample_rate
 
 
 class MusicGenPipeline(MusicGenerator):
@@ -251,9 +500,27 @@ class MusicGenPipeline(MusicGenerator):
         super().__init__(musicgen_config)
         self.processor = AutoProcessor.from_pretrained(self.config.model)
         self.model = MusicgenForConditionalGeneration.from_pretrained(
-            self.config.model
+            self.config.model,
+            torch_dtype=getattr(torch, self.config.dtype),
+            # fused attention kernels (flash / memory efficient) through torch's scaled_dot_product_attention
+            attn_implementation="sdpa",
         ).to(self.config.device)
         self.model.eval()
+        if self.config.compile:
+            # the decoder is left eager: its kv cache grows at every generated token and MusicGen has no
+            # fixed-size cache, so a static-shape compilation would recompile at each step.
+            # The forward is compiled instead of the module, generate inspects the signature of the encoder
+            self.model.text_encoder.forward = torch.compile(
+                self.model.text_encoder.forward, mode="reduce-overhead", fullgraph=False, dynamic=False
+            )
+
+        # the conversion of the inputs depends only on the input type, it's selected once
+        self._emb_size = self.get_embedding_size()
+        self._transform = {
+            "text": self._tokenize_text,
+            "token_embeddings": lambda i: {"inputs_embeds": i},
+            "embeddings": lambda i: {"encoder_outputs": i},
+        }[self.config.input_type]
 
     def token_to_text(self, token_embs):
         embedding_mat = self.model.get_input_embeddings().weight
@@ -267,7 +534,9 @@ class MusicGenPipeline(MusicGenerator):
         return self.processor.decode(closest_tokens)
 
     def text_to_embed(self, text, max_length=None):
-        inputs = self.prepare_inputs(text, max_length)
+        return self._encode_inputs(self.prepare_inputs(text, max_length), max_length)
+
+    def _encode_inputs(self, inputs, max_length=None):
         generation_config = self.model.generation_config
         generation_config = copy.deepcopy(generation_config)
         model_kwargs = generation_config.update(max_length=max_length)
@@ -301,11 +570,26 @@ class MusicGenPipeline(MusicGenerator):
     def get_embedding_size(self):
         return self.model.text_encoder.config.hidden_size
 
+    def encode_prompts(self, texts, input_type, max_length=None):
+        inputs = self.prepare_inputs(texts, max_length)
+        if input_type == "embeddings":
+            # with classifier free guidance the unconditional encodings follow the batch, only the prompts are kept
+            encoded = self._encode_inputs(inputs, max_length).last_hidden_state[: len(texts)]
+        else:
+            with torch.no_grad():
+                encoded = self.model.get_input_embeddings()(inputs["input_ids"])
+        # the padding of the batch is removed, each prompt keeps the length it has when encoded alone.
+        # The rows are copied out of the output, which belongs to the CUDA graph of the compiled encoder
+        # and is overwritten by its next replay
+        lengths = inputs["attention_mask"].sum(dim=1).tolist()
+        return [e[:n].clone() for e, n in zip(encoded, lengths)]
+
     def prepare_inputs(self, text, max_length=None):
         if max_length is None:
             max_length = self.processor.tokenizer.model_max_length
         inputs = self.processor(
-            text=[text],
+            text=[text] if isinstance(text, str) else list(text),
+            padding=True,
             return_tensors="pt",
             truncation=True,
             max_length=max_length,
@@ -315,36 +599,52 @@ class MusicGenPipeline(MusicGenerator):
                 inputs[key] = inputs[key].to(self.model.device)
         return inputs
 
-    def transform_inputs(self, inputs):
-        emb_size = self.get_embedding_size()
+    def transform_inputs(self, inputs, batched=False):
         if isinstance(inputs, torch.Tensor):
-            i = inputs.view(1, -1, emb_size).to(device=self.model.device)
+            batch_size = inputs.shape[0] if batched else 1
+            # solutions may be stored with a lower precision than the model
+            i = inputs.view(batch_size, -1, self._emb_size).to(device=self.model.device, dtype=self.model.dtype)
         else:
-            i = inputs
-        if self.config.input_type == "text":
-            outputs = self.processor(text=[i], return_tensors="pt")
-            for key in outputs:
-                if isinstance(outputs[key], torch.Tensor):
-                    outputs[key] = outputs[key].to(self.model.device)
-            return outputs
-        elif self.config.input_type == "token_embeddings":
-            return {"inputs_embeds": i}
-        elif self.config.input_type == "embeddings":
-            return {"encoder_outputs": i}
-
-    def generate_music(self, input, duration=5, name=None, **kwargs):
-        embeddings = self.transform_inputs(input)
-        audio_path = self.generate_path(name)
+            i = list(inputs) if batched else [inputs]
+        return self._transform(i)
+
+    def _tokenize_text(self, text):
+        # with a compiled encoder the prompts are padded to a few fixed lengths, to avoid recompiling for each length
+        outputs = self.processor(
+            text=text,
+            padding=True,
+            pad_to_multiple_of=TEXT_BUCKET if self.config.compile else None,
+            return_tensors="pt",
+        )
+        for key in outputs:
+            if isinstance(outputs[key], torch.Tensor):
+                outputs[key] = outputs[key].to(self.model.device)
+        return outputs
+
+    def generate_waveform(self, input, duration=5, batched=True, **kwargs):
+        embeddings = self.transform_inputs(input, batched)
         set_seed(0)
         kwargs["max_new_tokens"] = int(duration / 5 * 256)
-        audio_values = self.model.generate(
-            **embeddings, **kwargs, do_sample=True, top_k=0
-        )
-        sampling_rate = self.model.config.audio_encoder.sampling_rate
-        scipy.io.wavfile.write(
-            audio_path, rate=sampling_rate, data=audio_values[0, 0].cpu().numpy()
-        )
-        return audio_path
+        with torch.inference_mode():
+            audio_values = self.model.generate(
+                **embeddings, **kwargs, do_sample=True, top_k=0
+            )
+            return audio_values[:, 0]
+
+    def get_sampling_rate(self):
+        return self.model.config.audio_encoder.sampling_rate
+
+    def generate_music(self, input, duration=5, name=None, batched=False, **kwargs):
+        waveforms = self.generate_waveform(input, duration, batched, **kwargs)
+        sampling_rate = self.get_sampling_rate()
+        # converted to 16 bit PCM on the device, then moved to the host with a single transfer for the whole batch
+        waveforms = waveforms.float().clamp(-1, 1).mul(32767).to(torch.int16).cpu().numpy()
+        audio_paths = []
+        for audio in waveforms:
+            audio_path = self.generate_path(name)
+            self.write_async(scipy.io.wavfile.write, audio_path, sampling_rate, audio)
+            audio_paths.append(audio_path)
+        return audio_paths if batched else audio_paths[0]
 
 
 if __name__ == "__main__":
@@ -382,7 +682,7 @@ if __name__ == "__main__":
 
         riffusion_pipe = EasyRiffPipeline(cfg)
         embedding_pre = riffusion_pipe.text_to_embeddings_before_encoder(txt)
-        riffusion_pipe.generate_music(embedding)
+        riffusion_pipe.generate_music(embedding_pre)
 
     elif TEST == "musicgen":
         cfg = config.music_generator
@@ -1,6 +1,7 @@
 import os
-import json
+import orjson
 import torch
+from concurrent.futures import ThreadPoolExecutor
 from torch.utils.data import Dataset, DataLoader
 from tqdm import tqdm
 
@@ -11,6 +12,57 @@ from random import randint
 
 from EvoMusic.usrapprox.models.usr_emb import UsrEmb
 
+EMBEDDINGS_SHARD = "embeddings.npy"
+EMBEDDINGS_INDEX = "embeddings_index.json"
+
+
+def build_embedding_shard(embs_path):
+    """
+    One-time preprocessing packing the per-song JSON embeddings of a directory into a single float32 array.
+    The array is saved as 'embeddings.npy' in the same directory, with the row of each song id in 'embeddings_index.json'.
+    """
+    song_ids = sorted(
+        entry.name[: -len(".json")]
+        for entry in os.scandir(embs_path)
+        if entry.name.endswith(".json") and entry.name != EMBEDDINGS_INDEX
+    )
+
+    embeddings = []
+    id2row = {}
+    for song_id in tqdm(song_ids, desc="Packing embeddings"):
+        try:
+            with open(os.path.join(embs_path, f"{song_id}.json"), "rb") as f:
+                data = orjson.loads(f.read())
+        except orjson.JSONDecodeError:
+            print(f"[ERROR] Failed to decode JSON for {song_id}")
+            continue
+        if song_id not in data:
+            print(f"[WARNING] Key '{song_id}' not found in its embedding file")
+            continue
+        id2row[song_id] = len(embeddings)
+        embeddings.append(np.asarray(data[song_id][0], dtype=np.float32))
+
+    np.save(os.path.join(embs_path, EMBEDDINGS_SHARD), np.stack(embeddings), allow_pickle=False)
+    with open(os.path.join(embs_path, EMBEDDINGS_INDEX), "wb") as f:
+        f.write(orjson.dumps(id2row))
+
+
+def load_embedding_shard(embs_path):
+    """
+    Memory-map the packed embeddings of a directory, packing them first if needed.
+
+    Returns:
+        tuple[np.ndarray, dict[str, int]]: the read-only embeddings and the row of each song id
+    """
+    shard_path = os.path.join(embs_path, EMBEDDINGS_SHARD)
+    if not os.path.isfile(shard_path):
+        print("[DATASET] Packing the embeddings into a single file, this is done only once")
+        build_embedding_shard(embs_path)
+
+    with open(os.path.join(embs_path, EMBEDDINGS_INDEX), "rb") as f:
+        id2row = orjson.loads(f.read())
+    return np.load(shard_path, mmap_mode="r"), id2row
+
 class ContrDatasetMERT(Dataset):
     # static embeddings variable to store the embeddings
     embeddings = {}
@@ -74,20 +126,47 @@ class ContrDatasetMERT(Dataset):
         emb_file = os.path.join(self.embs_dir, f"{key}.json")
         if os.path.isfile(emb_file):
             try:
-                with open(emb_file, "r") as f:
-                    data = json.load(f)
+                with open(emb_file, "rb") as f:
+                    data = orjson.loads(f.read())
                     if key in data:
                         return key, data[key][0]
                     else:
                         print(f"[WARNING] Key '{key}' not found in {emb_file}")
                         return key, None
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 print(f"[ERROR] Failed to decode JSON from {emb_file}")
                 return key, None
         else:
             print(f"[WARNING] Embedding file '{emb_file}' does not exist")
             return key, None
 
+    def _read_embedding(self, key):
+        """
+        Reads the embedding of a song, with a placeholder if it cannot be loaded.
+        """
+        if key in ContrDatasetMERT.embeddings:
+            return ContrDatasetMERT.embeddings[key]
+        _, emb = self._load_embedding(key)
+        return [0.0] if emb is None else emb  # Placeholder
+
+    def _get_io_pool(self):
+        """
+        Thread pool reading the embedding files, created lazily by each DataLoader worker
+        as the threads of the parent process do not survive the fork.
+        """
+        pid = os.getpid()
+        if getattr(self, "_io_pool_pid", None) != pid:
+            self._io_pool = ThreadPoolExecutor(max_workers=min(1 + self.nneg, 16))
+            self._io_pool_pid = pid
+        return self._io_pool
+
+    def __getstate__(self):
+        # the thread pool is not picklable, workers started with spawn create their own
+        state = self.__dict__.copy()
+        state.pop("_io_pool", None)
+        state.pop("_io_pool_pid", None)
+        return state
+
     def __len__(self):
         return self.nusers * self.multiplier
 
@@ -113,50 +192,16 @@ class ContrDatasetMERT(Dataset):
         # Take random negative samples
         negset = np.random.choice(neg, size=self.nneg, replace=False)
 
-        poslist = []
+        # Load the embeddings from disk, the files of the item are read concurrently
+        embs = list(self._get_io_pool().map(self._read_embedding, [posset, *negset]))
+        poslist = embs[:1]
+        neglist = embs[1:]
 
-        # Load the embeddings from disk
-        emb_file = os.path.join(self.embs_dir, f"{posset}.json")
-        if os.path.isfile(emb_file):
-            try:
-                with open(emb_file, "r") as f:
-                    data = json.load(f)
-                    if posset in data:
-                        poslist = [data[posset][0]]
-                    else:
-                        print(f"[WARNING] Key '{posset}' not found in {emb_file}")
-                        poslist = [[0.0]]  # Placeholder
-            except json.JSONDecodeError:
-                print(f"[ERROR] Failed to decode JSON from {emb_file}")
-                poslist = [[0.0]]  # Placeholder
-        else:
-            print(f"[WARNING] Embedding file '{emb_file}' does not exist")
-            poslist = [[0.0]]  # Placeholder
-
-        neglist = []
-        for neg in negset:
-            emb_file = os.path.join(self.embs_dir, f"{neg}.json")
-            if os.path.isfile(emb_file):
-                try:
-                    with open(emb_file, "r") as f:
-                        data = json.load(f)
-                        if neg in data:
-                            neg_emb = data[neg][0]
-                        else:
-                            print(f"[WARNING] Key '{neg}' not found in {emb_file}")
-                            neg_emb = [0.0]  # Placeholder
-                except json.JSONDecodeError:
-                    print(f"[ERROR] Failed to decode JSON from {emb_file}")
-                    neg_emb = [0.0]  # Placeholder
-            else:
-                print(f"[WARNING] Embedding file '{emb_file}' does not exist")
-                neg_emb = [0.0]  # Placeholder
-            neglist.append(neg_emb)
-
-        posemb = torch.Tensor(poslist)
+        # nested lists are converted by numpy in one pass and shared with torch without a copy
+        posemb = torch.from_numpy(np.asarray(poslist, dtype=np.float32))
         # print(len(poslist))
         # print(len(neglist))
-        negemb = torch.Tensor(neglist)
+        negemb = torch.from_numpy(np.asarray(neglist, dtype=np.float32))
 
 
         return idx, posemb, negemb, weight
@@ -164,15 +209,17 @@ class ContrDatasetMERT(Dataset):
 class AllSongsDataset(Dataset):
     def __init__(self, splits_path, embs_path, partition="train"):
         self.embs_path = embs_path
-        with open(splits_path, "r") as f:
-            splits = json.load(f)
-        self.splits = splits[partition]
+        with open(splits_path, "rb") as f:
+            splits = orjson.loads(f.read())
+        self._emb, self._id2row = load_embedding_shard(embs_path)
+        # songs without an embedding are skipped
+        self.splits = [song_id for song_id in splits[partition] if song_id in self._id2row]
 
     def __getitem__(self, index):
-        # Return pairs of embeddings (index and index+1)
-        embedding1 = self.__get_embedding(index)
-        embedding2 = self.__get_embedding(index)  # Ensure valid index
-        return torch.Tensor([embedding1, embedding2]), index
+        # the aligner expects pairs of embeddings, the song is copied once out of the read-only shard
+        # and paired with itself through a view, the collate function stacks the batch in a single copy
+        embedding = torch.from_numpy(np.array(self.__get_embedding(index)))
+        return embedding.expand(2, -1), index
 
     def __len__(self):
         # return len(self.splits)
@@ -180,23 +227,7 @@ class AllSongsDataset(Dataset):
         return 300
 
     def __get_embedding(self, idx):
-        song_id = self.splits[idx]
-        emb_file = os.path.join(self.embs_path, f"{song_id}.json")
-        if os.path.isfile(emb_file):
-            try:
-                with open(emb_file, "r") as f:
-                    data = json.load(f)
-                    if song_id in data:
-                        return data[song_id][0]
-                    else:
-                        print("No embeddings for song_id")
-                        return [0.0]
-            except:
-                print("Error reading file")
-                return [0.0]
-        else:
-            print("File does not exist")
-            return [0.0]
+        return self._emb[self._id2row[self.splits[idx]]]
 
 class UserDefinedContrastiveDataset(Dataset):
     def __init__(
@@ -218,13 +249,15 @@ class UserDefinedContrastiveDataset(Dataset):
 
         self.embs_path = embs_path
 
-        with open(splits_path, "r") as f:
-            splits = json.load(f)
+        with open(splits_path, "rb") as f:
+            splits = orjson.loads(f.read())
             
-        self.splits = splits[partition]
-        self.index_to_song_id = {
-            idx: song_id for idx, song_id in enumerate(self.splits)
-        }
+        self._emb, self._id2row = load_embedding_shard(embs_path)
+        # songs without an embedding are skipped
+        self.splits = [song_id for song_id in splits[partition] if song_id in self._id2row]
+
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        alignerV2.to(device)
 
         all_songs_dataset = AllSongsDataset(splits_path, embs_path, partition)
         dataloader = DataLoader(
@@ -232,63 +265,64 @@ class UserDefinedContrastiveDataset(Dataset):
             batch_size=batch_size,
             shuffle=False,
             # num_workers=num_workers,
+            # batches in page-locked memory are copied to the gpu asynchronously
+            pin_memory=device.type == "cuda",
         )
 
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        alignerV2.to(device)
-
-        self.positive_samples = []
-        self.negative_samples = []
+        all_scores = []
+        all_indices = []
 
         # Process feedback for song pairs
         with torch.no_grad():
             for emb, indices in tqdm(dataloader, desc="Processing Feedback"):
-                emb = emb.to(device)
+                emb = emb.to(device, non_blocking=True)
                 # index_tensor = torch.LongTensor([user_id] * emb.shape[0]).to(device)
 
                 # batch = torch.cat((emb1, emb2), dim=1)
                 batch = emb
                 _, _, _, feedback_scores = alignerV2(user_id, batch)
 
-                feedback_scores = feedback_scores.cpu().tolist()
-                for idx, score in zip(indices.tolist(), feedback_scores):
-                    song_id = self.index_to_song_id[idx]
-                    # for score in score_vector:
-                    if score[0] > 0:
-                        self.positive_samples.append((song_id, score[0]))
-                    else:
-                        self.negative_samples.append((song_id, score[0]))
+                # keep the scores on the device, they are split all at once at the end
+                all_scores.append(feedback_scores[:, 0])
+                all_indices.append(indices)
+
+        # split the songs in positive and negative samples based on the feedback of the user
+        all_scores = torch.cat(all_scores).cpu().numpy()
+        all_indices = torch.cat(all_indices).numpy()
+        song_ids = np.array(self.splits, dtype=object)[all_indices]
+        pos_mask = all_scores > 0
+
+        self.positive_ids = song_ids[pos_mask]
+        self.positive_scores = all_scores[pos_mask]
+        self.negative_ids = song_ids[~pos_mask]
+        self.negative_scores = all_scores[~pos_mask]
+
+        # rows of the samples in the embeddings shard, so that each item is read with a single fancy index
+        self._pos_rows = np.array([self._id2row[song_id] for song_id in self.positive_ids], dtype=np.int64)
+        self._neg_rows = np.array([self._id2row[song_id] for song_id in self.negative_ids], dtype=np.int64)
 
         self.npos = npos
         self.nneg = nneg
 
     def __getitem__(self, index):
-        assert len(self.positive_samples) >= self.npos, "Not enough positive samples."
-        assert len(self.negative_samples) >= self.nneg, "Not enough negative samples."
+        assert len(self.positive_ids) >= self.npos, "Not enough positive samples."
+        assert len(self.negative_ids) >= self.nneg, "Not enough negative samples."
 
         # set two value to randomly n,m with sum up to 30
         if self.random_pool != None:
             n, m = 0, 0
             while n + m != self.random_pool:
-                n = torch.randint(1, self.random_pool, (1,))
+                n = int(torch.randint(1, self.random_pool, (1,)))
                 m = self.random_pool - n
 
-            pos_samples = torch.randperm(len(self.positive_samples))[:m]
-            neg_samples = torch.randperm(len(self.negative_samples))[:n]
+            pos_rows = np.random.choice(self._pos_rows, m, replace=False)
+            neg_rows = np.random.choice(self._neg_rows, n, replace=False)
         else:
-            pos_samples = torch.randperm(len(self.positive_samples))[: self.npos]
-            neg_samples = torch.randperm(len(self.negative_samples))[: self.nneg]
-            positives = [
-                self.__get_embedding(self.positive_samples[i][0]) for i in pos_samples
-            ]
-            negatives = [
-                self.__get_embedding(self.negative_samples[i][0]) for i in neg_samples
-            ]
+            pos_rows = np.random.choice(self._pos_rows, self.npos, replace=False)
+            neg_rows = np.random.choice(self._neg_rows, self.nneg, replace=False)
 
-        positives = torch.Tensor(positives)
-        negatives = torch.Tensor(negatives)
-
-        merged = torch.cat((positives, negatives), dim=0)
+        # one read from the shard for all the samples of the item
+        merged = torch.from_numpy(self._emb[np.concatenate((pos_rows, neg_rows))])
 
         return merged
 
@@ -297,24 +331,6 @@ class UserDefinedContrastiveDataset(Dataset):
         # return 50
         return 300
 
-    def __get_embedding(self, song_id):
-        emb_file = os.path.join(self.embs_path, f"{song_id}.json")
-        if os.path.isfile(emb_file):
-            try:
-                with open(emb_file, "r") as f:
-                    data = json.load(f)
-                    if song_id in data:
-                        return data[song_id][0]
-                    else:
-                        print("No embeddings for song_id")
-                        return [0.0]
-            except:
-                print("Error reading file")
-                return [0.0]
-        else:
-            print("File does not exist")
-            return [0.0]
-
 
 class ContrDatasetWrapper(ContrDatasetMERT):
     def __init__(
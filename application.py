@@ -1,5 +1,6 @@
 from diffusers.utils.testing_utils import enable_full_determinism
 from EvoMusic.application import EvoMusic
+from EvoMusic.evolution import _rng
 
 import torch
 import numpy as np
@@ -11,7 +12,8 @@ if __name__ == "__main__":
     # Set random seed for reproducibility
     seed = 42
     torch.manual_seed(seed)
-    np.random.seed(seed)
+    # numpy and the compiled selection draws of the searcher
+    _rng.seed(seed)
     random.seed(seed)
     torch.cuda.seed_all()
         
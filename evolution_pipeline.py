@@ -1,5 +1,6 @@
 from diffusers.utils.testing_utils import enable_full_determinism
 from EvoMusic.application import EvoMusic
+from EvoMusic.evolution import _rng
 
 import torch
 import numpy as np
@@ -26,7 +27,8 @@ if __name__ == "__main__":
     # Set random seed for reproducibility
     seed = parser.parse_args().seed
     torch.manual_seed(seed)
-    np.random.seed(seed)
+    # numpy and the compiled selection draws of the searcher
+    _rng.seed(seed)
     random.seed(seed)
     torch.cuda.seed_all()
 
@@ -20,6 +20,8 @@ setup(
         'python-dotenv==1.0.1',
         'PyYAML==6.0.1',
         'requests==2.32.3',
+        'aiohttp==3.10.10',
+        'orjson==3.10.12',
         'resampy==0.2.2',
         'scikit-learn==1.5.2',
         'scipy==1.13.1',
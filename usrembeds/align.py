@@ -5,7 +5,6 @@ import numpy as np
 
 import torch.nn as nn
 import matplotlib.pyplot as plt
-import scipy.signal as sps
 from sklearn.metrics import roc_curve, roc_auc_score, average_precision_score
 
 from tqdm import tqdm
@@ -19,11 +18,8 @@ DEVICE = "cuda" if torch.cuda.is_available() else "cpu"  # use GPU if we can!
 
 def load_wav(track_path, resample, audio_len):
 
-    # Convert mp3 to wav
-    y, sr = librosa.load(track_path, sr=None)
-
-    number_of_samples = round(len(y) * float(resample) / sr)
-    y = sps.resample(y, number_of_samples)
+    # Convert mp3 to wav, resampled while decoding with soxr
+    y, sr = librosa.load(track_path, sr=resample)
 
     # if audio is too short, repeat it
     pad_times = int((sr * audio_len) / len(y))
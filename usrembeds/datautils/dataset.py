@@ -1,23 +1,170 @@
 import json
+import orjson
 import os
 import torch
 import pandas as pd
 import librosa
 import numpy as np
-import scipy.signal as sps
+import soundfile as sf
 
 
 from torch.utils.data import Dataset
 from tqdm import tqdm
 from random import randint
 
-import concurrent.futures  # Added for multi-threading
+import concurrent.futures
+from collections import defaultdict
+from functools import lru_cache
+from itertools import repeat
+
+
+EMBEDDINGS_PACK = "embeddings.npy"
+EMBEDDINGS_INDEX = "embeddings_index.json"
+# chunks written by embedgen_MERT.py, 'embeddings_part_{n}.npy' with the ids of the rows in 'embeddings_part_{n}_index.json'
+EMBEDDINGS_PART = "embeddings_part_"
+# rounds of rejection sampling of the negatives before falling back to drawing among the non-positive songs
+REJECTION_ROUNDS = 8
+
+
+def _load_embedding(embs_dir, key):
+    """
+    Helper function to load a single embedding JSON file.
+    Returns a tuple of (key, embedding) or (key, None) if not found.
+    """
+    emb_file = os.path.join(embs_dir, f"{key}.json")
+    if os.path.isfile(emb_file):
+        try:
+            with open(emb_file, "rb") as f:
+                data = orjson.loads(f.read())
+                if key in data:
+                    return key, data[key][0]
+                else:
+                    print(f"[WARNING] Key '{key}' not found in {emb_file}")
+                    return key, None
+        except orjson.JSONDecodeError:
+            print(f"[ERROR] Failed to decode JSON from {emb_file}")
+            return key, None
+    else:
+        print(f"[WARNING] Embedding file '{emb_file}' does not exist")
+        return key, None
+
+
+def _pack_parts(embs_dir, parts):
+    """
+    Concatenates the NumPy chunks written by embedgen_MERT.py, keeping the first snippet of each track.
+    """
+    key2row = {}
+    table = []
+    for part in tqdm(parts, desc="Packing embeddings"):
+        with open(os.path.join(embs_dir, part[: -len(".npy")] + "_index.json"), "rb") as f:
+            ids = orjson.loads(f.read())["ids"]
+        rows = np.load(os.path.join(embs_dir, part))
+        for key, row in zip(ids, rows):
+            if key not in key2row:
+                key2row[key] = len(table)
+                table.append(row)
+    return key2row, table
+
+
+def build_embedding_pack(embs_dir, max_workers=12):
+    """
+    One-time preprocessing packing all the embeddings of a directory into a single float32 array of shape (N, D),
+    saved as 'embeddings.npy' in the same directory, with the row of each key in 'embeddings_index.json'.
+    The embeddings are read from the NumPy chunks of embedgen_MERT.py if any, otherwise from the '{key}.json' files.
+    """
+    parts = sorted(
+        (file for file in os.listdir(embs_dir) if file.startswith(EMBEDDINGS_PART) and file.endswith(".npy")),
+        key=lambda file: int(file[len(EMBEDDINGS_PART) : -len(".npy")]),
+    )
+    if parts:
+        key2row, table = _pack_parts(embs_dir, parts)
+        np.save(os.path.join(embs_dir, EMBEDDINGS_PACK), np.stack(table), allow_pickle=False)
+        with open(os.path.join(embs_dir, EMBEDDINGS_INDEX), "wb") as f:
+            f.write(orjson.dumps(key2row))
+        print(f"[DATASET] Packed {len(key2row)} embeddings from {len(parts)} chunks")
+        return
+
+    keys = sorted(
+        file[: -len(".json")]
+        for file in os.listdir(embs_dir)
+        if file.endswith(".json") and file != EMBEDDINGS_INDEX
+    )
 
+    # parsing the JSON files is CPU bound and holds the GIL, it's spread over processes rather than threads
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # Use list to eagerly evaluate and use tqdm for progress bar
+        results = list(
+            tqdm(
+                executor.map(_load_embedding, repeat(embs_dir), keys, chunksize=64),
+                total=len(keys),
+                desc="Packing embeddings",
+            )
+        )
 
-class ContrDatasetMERT(Dataset):
-    # static embeddings variable to store the embeddings
-    embeddings = {}
+    key2row = {}
+    table = []
+    for key, emb in results:
+        if emb is not None:
+            key2row[key] = len(table)
+            table.append(np.asarray(emb, dtype=np.float32))
+
+    np.save(os.path.join(embs_dir, EMBEDDINGS_PACK), np.stack(table), allow_pickle=False)
+    with open(os.path.join(embs_dir, EMBEDDINGS_INDEX), "wb") as f:
+        f.write(orjson.dumps(key2row))
+    print(f"[DATASET] Packed {len(key2row)} embeddings out of {len(keys)}")
+
+
+def load_embedding_pack(embs_dir, in_memory=False, max_workers=12):
+    """
+    Loads the packed embeddings of a directory, packing them first if needed.
+    The array is memory-mapped unless in_memory is True, so that DataLoader workers share the same pages.
+
+    Returns:
+        tuple[np.ndarray, dict[str, int]]: the embeddings and the row of each key
+    """
+    pack_path = os.path.join(embs_dir, EMBEDDINGS_PACK)
+    if not os.path.isfile(pack_path):
+        print("[DATASET] Packing the embeddings into a single file, this is done only once")
+        build_embedding_pack(embs_dir, max_workers)
+
+    with open(os.path.join(embs_dir, EMBEDDINGS_INDEX), "rb") as f:
+        key2row = orjson.loads(f.read())
+    return np.load(pack_path, mmap_mode=None if in_memory else "r"), key2row
+
+
+def load_audio(path, sr=None):
+    """
+    Decodes an audio file to a mono float32 waveform with libsndfile, falling back to librosa (audioread)
+    for the formats libsndfile cannot read. The audio is resampled to sr with soxr unless sr is None.
+
+    Returns:
+        tuple[np.ndarray, int]: the waveform and its sampling rate
+    """
+    try:
+        y, native_sr = sf.read(path, dtype="float32", always_2d=False)
+    except RuntimeError:  # sf.LibsndfileError on recent versions of soundfile
+        return librosa.load(path, sr=sr)
+
+    if y.ndim > 1:
+        y = y.mean(axis=1)
+    if sr is not None and sr != native_sr:
+        y = librosa.resample(y, orig_sr=native_sr, target_sr=sr, res_type="soxr_hq")
+        return y, sr
+    return y, native_sr
+
+
+@lru_cache(maxsize=8)
+def _load_audio_cached(path, sr=None):
+    """
+    Cached version of 'load_audio', used to decode a track once for all its snippets.
+    The returned waveform is shared between the calls and read-only.
+    """
+    y, sr = load_audio(path, sr)
+    y.setflags(write=False)
+    return y, sr
 
+
+class ContrDatasetMERT(Dataset):
     def __init__(
         self,
         embs_dir,
@@ -27,21 +174,28 @@ class ContrDatasetMERT(Dataset):
         nneg=10,
         multiplier=10,
         transform=None,
-        preload=False,  # New parameter for preloading
-        max_workers=12,  # Number of threads for preloading
+        preload=False,  # Read the whole embeddings pack into shared memory instead of memory-mapping it
+        max_workers=12,  # Number of processes for packing the embeddings
+        neg_cache=256,  # Number of items whose negatives are drawn at once for each user
     ):
         self.embs_dir = embs_dir
         self.stats_path = stats_path
         self.nneg = nneg
         self.multiplier = multiplier
         self.transform = transform
-        self.preload = preload  # Store the preload flag
-        self.max_workers = max_workers  # Number of threads
+        self.preload = preload
+        self.max_workers = max_workers
+        self.neg_cache = neg_cache
 
         print("[DATASET] Creating dataset")
 
-        # Set embedding keys from the split
-        self.emb_keys = split
+        self.table, self.key2row = load_embedding_pack(embs_dir, preload, max_workers)
+        if self.preload:
+            # a single copy in shared memory read by all the DataLoader workers, also with the spawn start method
+            self.table = torch.from_numpy(self.table).share_memory_()
+
+        # Set embedding keys from the split, skipping the songs without embeddings
+        self.emb_keys = [key for key in split if key in self.key2row]
 
         # Load the stats
         self.stats = pd.read_csv(stats_path)
@@ -62,70 +216,51 @@ class ContrDatasetMERT(Dataset):
         self.userstd = self.stats.groupby("userid")["count"].std()
         self.usercount = self.stats.groupby("userid")["count"].count()
 
-        self.user2songs = (
-            self.stats.groupby("userid")
-            .apply(lambda x: list(zip(x["id"], x["count"])))
-            .to_dict()
-        )
+        # Positive songs of each user with their weight, computed once as the user stats do not change
+        top70 = (self.usersums / self.usercount + self.userstd).to_dict()
+        user2songs = defaultdict(list)
+        for usr, song, count in self.stats[["userid", "id", "count"]].itertuples(index=False):
+            user2songs[usr].append((song, min(1, count / top70[usr])))
+        self.user2songs = dict(user2songs)
 
         # Number of users
         self.nusers = self.stats["userid"].nunique()
 
-        # Preload embeddings into memory if preload=True
-        if self.preload:
-            print("[DATASET] Preloading embeddings into RAM using multi-threading")
-            self._preload_embeddings()
+        # Pack rows of the negative candidates of each user, the songs of the split the user did not listen to
+        all_rows = np.array([self.key2row[key] for key in self.emb_keys], dtype=np.int64)
+        self.user2neg = {
+            usr: np.setdiff1d(all_rows, [self.key2row[song] for song, _ in songs])
+            for usr, songs in self.user2songs.items()
+        }
 
-    def _load_embedding(self, key):
-        """
-        Helper function to load a single embedding JSON file.
-        Returns a tuple of (key, embedding) or (key, None) if not found.
-        """
-        if key in ContrDatasetMERT.embeddings:
-            return None  # Skip if already loaded
-        emb_file = os.path.join(self.embs_dir, f"{key}.json")
-        if os.path.isfile(emb_file):
-            try:
-                with open(emb_file, "r") as f:
-                    data = json.load(f)
-                    if key in data:
-                        return key, data[key][0]
-                    else:
-                        print(f"[WARNING] Key '{key}' not found in {emb_file}")
-                        return key, None
-            except json.JSONDecodeError:
-                print(f"[ERROR] Failed to decode JSON from {emb_file}")
-                return key, None
-        else:
-            print(f"[WARNING] Embedding file '{emb_file}' does not exist")
-            return key, None
+        # Negatives drawn in advance for each user and the position of the next unused ones.
+        # They are filled on first use, so that each DataLoader worker draws its own
+        self.neg_buffer = {}
+        self.neg_cursor = {}
 
-    def _preload_embeddings(self):
+    def __len__(self):
+        return self.nusers * self.multiplier
+
+    def _sample_negatives(self, usr):
         """
-        Preloads all embeddings into the self.embeddings dictionary using multi-threading.
+        Returns nneg distinct negative rows for the user, taken from a buffer of distinct negatives
+        drawn without replacement and refilled once exhausted.
         """
-        with concurrent.futures.ThreadPoolExecutor(
-            max_workers=self.max_workers
-        ) as executor:
-            # Use list to eagerly evaluate and use tqdm for progress bar
-            results = list(
-                tqdm(
-                    executor.map(self._load_embedding, self.emb_keys),
-                    total=len(self.emb_keys),
-                    desc="Preloading embeddings",
+        buffer = self.neg_buffer.get(usr)
+        cursor = self.neg_cursor.get(usr, 0)
+        if buffer is None or cursor + self.nneg > len(buffer):
+            candidates = self.user2neg[usr]
+            if len(candidates) < self.nneg:
+                raise ValueError(
+                    f"User {usr} has {len(candidates)} candidate negatives, at least nneg={self.nneg} are needed"
                 )
-            )
-
-        # Populate the embeddings dictionary
-        for key, emb in results:
-            if emb is not None:
-                ContrDatasetMERT.embeddings[key] = emb
-        print(
-            f"[DATASET] Preloaded {len(ContrDatasetMERT.embeddings)} embeddings out of {len(self.emb_keys)}"
-        )
-
-    def __len__(self):
-        return self.nusers * self.multiplier
+            # a whole number of items, so that no negative is repeated within an item
+            size = min(len(candidates) // self.nneg, self.neg_cache) * self.nneg
+            buffer = np.random.choice(candidates, size=size, replace=False)
+            self.neg_buffer[usr] = buffer
+            cursor = 0
+        self.neg_cursor[usr] = cursor + self.nneg
+        return buffer[cursor : cursor + self.nneg]
 
     def __getitem__(self, idx):
 
@@ -135,70 +270,16 @@ class ContrDatasetMERT(Dataset):
 
         pos = self.user2songs[usr]
 
-        neg = list(set(self.emb_keys) - set([song for song, _ in pos]))
-
-        # Take random positive sample
+        # Take random positive sample with its weight
         pos_sample = pos[randint(0, len(pos) - 1)]
-        posset, count = pos_sample
-
-        # Compute pos sample weight
-        mean = self.usersums[usr] / self.usercount[usr]
-        top70 = mean + self.userstd[usr]
-        weight = min(1, count / top70)
+        posset, weight = pos_sample
 
         # Take random negative samples
-        negset = np.random.choice(neg, size=self.nneg, replace=False)
+        negrows = self._sample_negatives(usr)
 
-        poslist = []
-
-        if self.preload:
-            # Use preloaded embeddings
-            poslist = [ContrDatasetMERT.embeddings[posset]]
-        else:
-            # Load the embeddings from disk
-            emb_file = os.path.join(self.embs_dir, f"{posset}.json")
-            if os.path.isfile(emb_file):
-                try:
-                    with open(emb_file, "r") as f:
-                        data = json.load(f)
-                        if posset in data:
-                            poslist = [data[posset][0]]
-                        else:
-                            print(f"[WARNING] Key '{posset}' not found in {emb_file}")
-                            poslist = [[0.0]]  # Placeholder
-                except json.JSONDecodeError:
-                    print(f"[ERROR] Failed to decode JSON from {emb_file}")
-                    poslist = [[0.0]]  # Placeholder
-            else:
-                print(f"[WARNING] Embedding file '{emb_file}' does not exist")
-                poslist = [[0.0]]  # Placeholder
-
-        neglist = []
-        for neg in negset:
-            if self.preload:
-                neg_emb = ContrDatasetMERT.embeddings[neg]
-                neglist.append(neg_emb)
-            else:
-                emb_file = os.path.join(self.embs_dir, f"{neg}.json")
-                if os.path.isfile(emb_file):
-                    try:
-                        with open(emb_file, "r") as f:
-                            data = json.load(f)
-                            if neg in data:
-                                neg_emb = data[neg][0]
-                            else:
-                                print(f"[WARNING] Key '{neg}' not found in {emb_file}")
-                                neg_emb = [0.0]  # Placeholder
-                    except json.JSONDecodeError:
-                        print(f"[ERROR] Failed to decode JSON from {emb_file}")
-                        neg_emb = [0.0]  # Placeholder
-                else:
-                    print(f"[WARNING] Embedding file '{emb_file}' does not exist")
-                    neg_emb = [0.0]  # Placeholder
-                neglist.append(neg_emb)
-
-        posemb = torch.Tensor(poslist)
-        negemb = torch.Tensor(neglist)
+        # Slice the rows from the pack, fancy indexing copies them out of the memory map or the shared tensor
+        posemb = torch.as_tensor(self.table[[self.key2row[posset]]])
+        negemb = torch.as_tensor(self.table[negrows])
 
         return idx, posemb, negemb, weight
 
@@ -224,8 +305,8 @@ class ContrDatasetOL3(Dataset):
         ]
         embedding_files.remove("allkeys.json")
 
-        with open(os.path.join(embs_dir, "allkeys.json"), "r") as f:
-            self.allkeys = json.load(f)
+        with open(os.path.join(embs_dir, "allkeys.json"), "rb") as f:
+            self.allkeys = orjson.loads(f.read())
 
         self.allkeys.remove("metadata")
 
@@ -237,8 +318,8 @@ class ContrDatasetOL3(Dataset):
 
         print("[DATASET] Loading embeddings")
         for num, file in enumerate(tqdm(embedding_files)):
-            with open(os.path.join(embs_dir, file), "r") as f:
-                data = json.load(f)
+            with open(os.path.join(embs_dir, file), "rb") as f:
+                data = orjson.loads(f.read())
                 for key, value in data.items():
                     if key != "metadata":
                         # print(len(value[0]))
@@ -246,6 +327,18 @@ class ContrDatasetOL3(Dataset):
                         #     breakpoint()
                         self.emb_list[self.emb_map[key]].extend(value)
 
+        # a single float32 array of shape (n_songs, max_snippets, D) padded with zeros, with the number of
+        # snippets of each song, so that the snippets of an item are gathered with one fancy index
+        self.emb_counts = np.array([len(embs) for embs in self.emb_list])
+        self.emb_dim = len(next(embs for embs in self.emb_list if len(embs) > 0)[0])
+        self.emb_arr = np.zeros(
+            (len(self.emb_list), self.emb_counts.max(), self.emb_dim), dtype=np.float32
+        )
+        for i, embs in enumerate(self.emb_list):
+            if len(embs) > 0:
+                self.emb_arr[i, : len(embs)] = embs
+        del self.emb_list
+
         print("[DATASET] Loading users stats")
         # load the stats
         self.stats = pd.read_csv(stats_path)
@@ -267,20 +360,53 @@ class ContrDatasetOL3(Dataset):
         self.userstd = self.stats.groupby("userid")["count"].std()
         self.usercount = self.stats.groupby("userid")["count"].count()
 
-        self.user2songs = (
-            self.stats.groupby("userid")
-            .apply(lambda x: list(zip(x["id"], x["count"])))
-            .to_dict()
-        )
+        # Positive songs of each user with their weight, computed once as the user stats do not change
+        top70 = (self.usersums / self.usercount + self.userstd).to_dict()
+        user2songs = defaultdict(list)
+        for usr, song, count in self.stats[["userid", "id", "count"]].itertuples(index=False):
+            user2songs[usr].append((song, min(1, count / top70[usr])))
+        self.user2songs = dict(user2songs)
         # breakpoint()
         # number of users
         self.nusers = self.stats["userid"].nunique()
 
+        # indices of the songs of each user, the negatives are drawn by rejection among all the songs,
+        # as users listen to a small fraction of them
+        self.user2pos = {
+            usr: np.unique([self.emb_map[song] for song, _ in songs])
+            for usr, songs in self.user2songs.items()
+        }
+
         # breakpoint()
 
     def __len__(self):
         return self.nusers * self.multiplier
 
+    def _sample_negatives(self, usr):
+        """
+        Draws nneg distinct songs the user did not listen to, with rejection sampling over all the songs.
+        """
+        positives = self.user2pos[usr]
+        available = len(self.allkeys) - len(positives)
+        if available < self.nneg:
+            raise ValueError(
+                f"User {usr} did not listen to {available} songs, at least nneg={self.nneg} are needed"
+            )
+
+        negs = np.empty(0, dtype=np.int64)
+        for _ in range(REJECTION_ROUNDS):
+            cand = np.random.randint(0, len(self.allkeys), size=2 * self.nneg)
+            cand = np.concatenate((negs, cand[~np.isin(cand, positives)]))
+            # drop the duplicates keeping the drawing order, so that the first nneg are a uniform draw
+            _, first = np.unique(cand, return_index=True)
+            negs = cand[np.sort(first)]
+            if len(negs) >= self.nneg:
+                return negs[: self.nneg]
+
+        # the user listened to most of the songs, the negatives are drawn among the remaining ones
+        candidates = np.setdiff1d(np.arange(len(self.allkeys)), positives, assume_unique=True)
+        return np.random.choice(candidates, size=self.nneg, replace=False)
+
     def __getitem__(self, idx):
 
         idx = idx % self.nusers
@@ -289,47 +415,21 @@ class ContrDatasetOL3(Dataset):
         # breakpoint()
         pos = self.user2songs[usr]
         # count = torch.Tensor(count).type(torch.int32)
-        neg = list(set(self.allkeys) - set(pos))
 
         pos_sample = pos[randint(0, len(pos) - 1)]
-        posset, count = pos_sample
-
-        mean = self.usersums[usr] / self.usercount[usr]
-        top70 = mean + self.userstd[usr]
-        weight = min(1, count / top70)
+        posset, weight = pos_sample
         # weight = torch.Tensor([weight])
         # breakpoint()
 
-        negset = np.random.choice(neg, size=self.nneg, replace=False)
-
-        poslist = []
-        # for pos in posset:
-        #     embs = self.emb_list[self.emb_map[pos]]
-        #     # if len(embs) == 0:
-        #     #     print(f"Empty embedding for {pos}")
-        #     #     breakpoint()
-        #     poslist.append(embs[randint(0, len(embs) - 1)])
-
-        embs = self.emb_list[self.emb_map[posset]]
-        poslist.append(embs[randint(0, len(embs) - 1)])
-
-        neglist = []
-        for neg in negset:
-            embs = self.emb_list[self.emb_map[neg]]
-            # if len(embs) == 0:
-            #     print(f"Empty embedding for {neg}")
-            #     breakpoint()
-            neglist.append(embs[randint(0, len(embs) - 1)])
-
-        # neglist = [
-        #     self.emb_list[self.emb_map[neg]][
-        #         randint(0, len(self.emb_list[self.emb_map[neg]]))
-        #     ]
-        #     for neg in negset
-        # ]
-
-        posemb = torch.Tensor(poslist)
-        negemb = torch.Tensor(neglist)
+        negset = self._sample_negatives(usr)
+
+        # a random snippet of the positive and of each negative, gathered at once
+        songs = np.concatenate(([self.emb_map[posset]], negset))
+        snippets = np.random.randint(0, self.emb_counts[songs])
+        embs = self.emb_arr[songs, snippets]
+
+        posemb = torch.from_numpy(embs[:1])
+        negemb = torch.from_numpy(embs[1:])
 
         # print(negemb.shape)
         # breakpoint()
@@ -370,20 +470,19 @@ class MusicDataset(Dataset):
 
     def __getitem__(self, idx):
 
-        idx = idx % len(self.tracks_paths)
+        # the snippets of a track are consecutive, so that the track is decoded once for all of them
+        idx = idx // self.repeat
 
         stat = {}
         track_path = self.tracks_paths[idx]
         stat["id"] = track_path.split("/")[-1].split("_")[0]
 
-        # Convert mp3 to wav
-        y, sr = librosa.load(track_path, sr=None)
+        # Convert mp3 to wav, resampled with soxr if needed
+        if self.repeat > 1:
+            y, sr = _load_audio_cached(track_path, sr=self.resample)
+        else:
+            y, sr = load_audio(track_path, sr=self.resample)
         stat["sr"] = sr
-        if self.resample is not None:
-            # Resample data
-            number_of_samples = round(len(y) * float(self.resample) / sr)
-            y = sps.resample(y, number_of_samples)
-            stat["sr"] = self.resample
 
         # if audio is too short, repeat it
         pad_times = int((sr * self.audio_len) / len(y))
@@ -432,19 +531,20 @@ def get_dataloaders(
         multiplier=mul,
     )
 
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        num_workers=workers,
-    )
+    # batches in page-locked memory are copied to the gpu asynchronously, and the workers are kept
+    # alive across epochs instead of being forked again with a copy of the dataset
+    loader_kwargs = {
+        "batch_size": batch_size,
+        "shuffle": True,
+        "num_workers": workers,
+        "pin_memory": torch.cuda.is_available(),
+        "persistent_workers": workers > 0,
+        "prefetch_factor": 4 if workers > 0 else None,
+    }
 
-    test_loader = torch.utils.data.DataLoader(
-        test_dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        num_workers=workers,
-    )
+    train_loader = torch.utils.data.DataLoader(train_dataset, **loader_kwargs)
+
+    test_loader = torch.utils.data.DataLoader(test_dataset, **loader_kwargs)
 
     return train_loader, test_loader, len(users)
 
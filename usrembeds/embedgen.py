@@ -70,7 +70,7 @@ if __name__ == "__main__":
         )
 
         # print(emb.shape)
-        # plot_music_batch(emb, DEVICE)
+        # plot_music_batch(emb)
         mean_emb = emb.mean(axis=1)
 
         for i, track_id in enumerate(stat["id"]):
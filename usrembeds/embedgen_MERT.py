@@ -1,11 +1,30 @@
 from datautils.dataset import MusicDataset
 import torch
 import json
+import numpy as np
 import os
 import time
 from transformers import AutoModel, Wav2Vec2FeatureExtractor
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# bfloat16 halves the memory traffic of the transformer, the embeddings are only averaged and compared by cosine similarity
+DTYPE = torch.bfloat16 if DEVICE == "cuda" else torch.float32
+
+
+def save_part(emb_path, part, ids, rows):
+    """
+    Saves the embeddings of a chunk as a float32 array of shape (n, hidden) in 'embeddings_part_{part}.npy',
+    with the track id of each row in 'embeddings_part_{part}_index.json'.
+    A track has one row for each of its snippets.
+    """
+    np.save(
+        os.path.join(emb_path, f"embeddings_part_{part}.npy"),
+        np.stack(rows).astype(np.float32),
+        allow_pickle=False,
+    )
+    with open(os.path.join(emb_path, f"embeddings_part_{part}_index.json"), "w") as f:
+        json.dump({"metadata": {"model": "MERT-v1-95M"}, "ids": ids}, f)
+
 
 if __name__ == "__main__":
     music_path = "D:/music"
@@ -30,43 +49,45 @@ if __name__ == "__main__":
 
     # Load MERT-v1-95M model and feature extractor
     model = AutoModel.from_pretrained("m-a-p/MERT-v1-95M", trust_remote_code=True).to(
-        DEVICE
+        DEVICE, DTYPE
     )
+    model.eval()
     feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(
         "m-a-p/MERT-v1-95M", trust_remote_code=True
     )
 
-    emb_dict = {"metadata": {"model": "MERT-v1-95M"}}
+    ids = []
+    rows = []
     part = 0
     mean_time = 0
     start_time = time.time()
     for idx, track in enumerate(dataloader):
         stat, audio = track
-        audio = audio.to(DEVICE)
 
-        # Process each audio in the batch
-        for i in range(audio.size(0)):
-            input_audio = audio[i].cpu().numpy()
-            inputs = feature_extractor(
-                input_audio, sampling_rate=24000, return_tensors="pt", padding=True
-            )
-            inputs = {key: val.to(DEVICE) for key, val in inputs.items()}
+        # Process the whole batch with a single forward pass, the feature extractor normalizes each audio on its own
+        input_audio = [audio[i].numpy() for i in range(audio.size(0))]
+        inputs = feature_extractor(
+            input_audio, sampling_rate=24000, return_tensors="pt", padding=True
+        )
+        inputs = {
+            key: val.to(DEVICE, DTYPE) if val.is_floating_point() else val.to(DEVICE)
+            for key, val in inputs.items()
+        }
 
-            with torch.no_grad():
-                outputs = model(**inputs, output_hidden_states=True)
-                hidden_states = torch.stack(outputs.hidden_states).squeeze()
-                mean_emb = hidden_states.mean(dim=(0, 1)).cpu().numpy()
+        with torch.inference_mode(), torch.autocast(DEVICE, dtype=DTYPE, enabled=DEVICE == "cuda"):
+            outputs = model(**inputs, output_hidden_states=True)
+            # (layers, batch, time, hidden) -> (batch, hidden), averaged in float32
+            hidden_states = torch.stack(outputs.hidden_states)
+            mean_embs = hidden_states.float().mean(dim=(0, 2)).cpu().numpy()
 
-            track_id = stat["id"][i]
-            if track_id not in emb_dict:
-                emb_dict[track_id] = []
-            emb_dict[track_id].append(mean_emb.tolist())
+        ids.extend(stat["id"])
+        rows.extend(mean_embs)
 
         if (idx + 1) % SAVE_RATE == 0:
-            with open(os.path.join(emb_path, f"embeddings_part_{part}.json"), "w") as f:
-                json.dump(emb_dict, f)
+            save_part(emb_path, part, ids, rows)
             part += 1
-            emb_dict = {}
+            ids = []
+            rows = []
 
         end_time = time.time()
         mean_time = (mean_time * idx + (end_time - start_time)) / (idx + 1)
@@ -80,6 +101,5 @@ if __name__ == "__main__":
         start_time = time.time()
 
     # Save any remaining embeddings
-    if emb_dict:
-        with open(os.path.join(emb_path, f"embeddings_part_{part}.json"), "w") as f:
-            json.dump(emb_dict, f)
+    if rows:
+        save_part(emb_path, part, ids, rows)
@@ -7,6 +7,7 @@ import torchopenl3
 import numpy as np
 
 import torch.nn as nn
+import torch.nn.functional as F
 from sklearn.metrics import roc_curve, roc_auc_score, average_precision_score
 
 from torch import optim
@@ -24,25 +25,72 @@ from torch.nn.utils import clip_grad_norm_
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"  # use GPU if we can!
 # print(f"Using {DEVICE}")
 
-
-def weighted_contrastive_loss(out, posemb, negemb, weights, loss_weight, temp=0.07):
-    cos = nn.CosineSimilarity(dim=2, eps=1e-6)
-    possim = cos(out, posemb)
-
-    out = out.repeat(1, negemb.shape[1], 1)
-    negsim = cos(out, negemb)
-
-    # breakpoint()
-    logits = torch.cat((possim, negsim), dim=1) * torch.exp(temp)
-    exp = torch.exp(logits)
-    denom = torch.sum(exp, dim=1) + 1e-6
-    loss = -torch.log(exp[:, 0] / denom)
+# mixed precision on the GPU, bfloat16 when supported as it needs no loss scaling
+if DEVICE == "cuda" and torch.cuda.is_bf16_supported():
+    AMP_DTYPE = torch.bfloat16
+else:
+    AMP_DTYPE = torch.float16
+AMP = DEVICE == "cuda"
+
+
+def gather_samples(posemb, negemb, buffer=None):
+    """
+    Copies the positive and negative samples of a batch next to each other in a persistent device buffer,
+    so that no new tensor is allocated at each step. The buffer is reallocated only when the batch does not fit.
+
+    Args:
+    - posemb (torch.Tensor): positive samples [B, 1, EMB], on the cpu
+    - negemb (torch.Tensor): negative samples [B, NNEG, EMB], on the cpu
+    - buffer (torch.Tensor): buffer returned by the previous call, None at the first one
+
+    Returns:
+    - allemb (torch.Tensor): view of the buffer with the samples [B, 1 + NNEG, EMB]
+    - buffer (torch.Tensor): buffer to pass to the next call
+    """
+    b, npos = posemb.shape[0], posemb.shape[1]
+    shape = (npos + negemb.shape[1], posemb.shape[2])
+    if buffer is None or buffer.shape[0] < b or buffer.shape[1:] != shape:
+        buffer = torch.empty((b, *shape), dtype=posemb.dtype, device=DEVICE)
+
+    allemb = buffer[:b]
+    allemb[:, :npos].copy_(posemb, non_blocking=True)
+    allemb[:, npos:].copy_(negemb, non_blocking=True)
+    return allemb, buffer
+
+
+def contrastive_similarities(out, posemb, negemb):
+    """
+    Cosine similarities between the user embeddings and their samples, computed with a single batched matmul.
+
+    Args:
+    - out (torch.Tensor): user embeddings [B, 1, EMB]
+    - posemb (torch.Tensor): positive samples [B, 1, EMB]
+    - negemb (torch.Tensor): negative samples [B, NNEG, EMB]
+
+    Returns:
+    - sims (torch.Tensor): similarities [B, 1 + NNEG] in float32, the positive first
+    """
+    # normalized in float32 so the dot products are cosines also under autocast
+    q = F.normalize(out.squeeze(1).float(), dim=-1, eps=1e-6)
+    k = F.normalize(torch.cat((posemb, negemb), dim=1).float(), dim=-1, eps=1e-6)
+    return torch.bmm(k, q.unsqueeze(-1)).squeeze(-1)
+
+
+def similarity_loss(sims, weights, loss_weight, temp=0.07):
+    # the positive is always at index 0
+    labels = torch.zeros(sims.shape[0], dtype=torch.long, device=sims.device)
+    loss = F.cross_entropy(sims * torch.exp(temp), labels, reduction="none")
 
     loss = loss * ((weights * loss_weight) + 1)
     loss = torch.mean(loss)
     return loss
 
 
+def weighted_contrastive_loss(out, posemb, negemb, weights, loss_weight, temp=0.07):
+    sims = contrastive_similarities(out, posemb, negemb)
+    return similarity_loss(sims, weights, loss_weight, temp=temp)
+
+
 def eval_auc_loop(model, val_loader, weight=0):
 
     model.eval()
@@ -50,6 +98,7 @@ def eval_auc_loop(model, val_loader, weight=0):
     positives = torch.empty(0)
     negatives = torch.empty(0)
     val_losses = []
+    buffer = None
     for tracks in tqdm(val_loader):
 
         # [B]
@@ -57,38 +106,30 @@ def eval_auc_loop(model, val_loader, weight=0):
         # [B, NNEG, EMB]
         idx, posemb, negemb, weights = tracks
 
-        idx = idx.to(DEVICE)
-        posemb = posemb.to(DEVICE)
-        negemb = negemb.to(DEVICE)
-        weights = weights.to(DEVICE)
+        idx = idx.to(DEVICE, non_blocking=True)
+        weights = weights.to(DEVICE, non_blocking=True)
 
-        allemb = torch.cat((posemb, negemb), dim=1)
+        allemb, buffer = gather_samples(posemb, negemb, buffer)
 
-        urs_x, embs, temp = model(idx, allemb)
+        with torch.no_grad(), torch.autocast(DEVICE, dtype=AMP_DTYPE, enabled=AMP):
+            urs_x, embs, temp = model(idx, allemb)
 
-        # breakpoint()
-        posemb_out = embs[:, 0, :].unsqueeze(dim=1)
-        negemb_out = embs[:, 1:, :]
+            # breakpoint()
+            posemb_out = embs[:, 0, :].unsqueeze(dim=1)
+            negemb_out = embs[:, 1:, :]
 
-        # breakpoint()
-        out = urs_x.unsqueeze(1)
+            # breakpoint()
+            out = urs_x.unsqueeze(1)
 
-        val_loss = weighted_contrastive_loss(
-            out, posemb_out, negemb_out, weights, weight, temp=temp
-        )
+            # the same similarities give the loss and the AUC scores
+            sims = contrastive_similarities(out, posemb_out, negemb_out)
+            val_loss = similarity_loss(sims, weights, weight, temp=temp)
 
         val_losses.append(val_loss.item())
 
-        # breakpoint()
-        cos = nn.CosineSimilarity(dim=2, eps=1e-6)
-
-        possim = cos(out, posemb_out).squeeze(1).cpu().detach()
-
-        out = out.repeat(1, negemb_out.shape[1], 1)
-        negsim = cos(out, negemb_out)
-
-        negsim = negsim.view(-1, negemb_out.shape[1])
-        negflat = negsim.flatten().cpu().detach()
+        sims = sims.cpu()
+        possim = sims[:, 0]
+        negflat = sims[:, 1:].flatten()
 
         positives = torch.cat((positives, possim))
         negatives = torch.cat((negatives, negflat))
@@ -108,42 +149,53 @@ def eval_auc_loop(model, val_loader, weight=0):
 
 
 def train_loop(
-    model, train_loader, opt, grads, weight, lt=False, log=False, log_every=100
+    model,
+    train_loader,
+    opt,
+    grads,
+    weight,
+    lt=False,
+    log=False,
+    log_every=100,
+    scaler=None,
 ):
 
     model.train()
 
+    if scaler is None:
+        scaler = torch.amp.GradScaler(DEVICE, enabled=False)
+
     losses = []
+    buffer = None
     for itr, tracks in enumerate(tqdm(train_loader)):
 
         # [B]
         # [B, 1, EMB]
         # [B, NNEG, EMB]
         idx, posemb, negemb, weights = tracks
-        idx = idx.to(DEVICE)
-        posemb = posemb.to(DEVICE)
-        negemb = negemb.to(DEVICE)
-        weights = weights.to(DEVICE)
+        idx = idx.to(DEVICE, non_blocking=True)
+        weights = weights.to(DEVICE, non_blocking=True)
 
         opt.zero_grad()
 
-        allemb = torch.cat((posemb, negemb), dim=1)
+        allemb, buffer = gather_samples(posemb, negemb, buffer)
 
-        urs_x, embs, temp = model(idx, allemb)
+        with torch.autocast(DEVICE, dtype=AMP_DTYPE, enabled=AMP):
+            urs_x, embs, temp = model(idx, allemb)
 
-        posemb_out = embs[:, 0, :].unsqueeze(dim=1)
-        negemb_out = embs[:, 1:, :]
+            posemb_out = embs[:, 0, :].unsqueeze(dim=1)
+            negemb_out = embs[:, 1:, :]
 
-        out = urs_x.unsqueeze(1)
+            out = urs_x.unsqueeze(1)
 
-        loss = weighted_contrastive_loss(
-            out,
-            posemb_out,
-            negemb_out,
-            weights,
-            weight,
-            temp=temp,
-        )
+            loss = weighted_contrastive_loss(
+                out,
+                posemb_out,
+                negemb_out,
+                weights,
+                weight,
+                temp=temp,
+            )
 
         if itr % log_every == 0 and log:
             if lt:
@@ -153,11 +205,13 @@ def train_loop(
 
         losses.append(loss.item())
 
-        loss.backward()
-        # gradient clipping
+        scaler.scale(loss).backward()
+        # gradient clipping, on the unscaled gradients
+        scaler.unscale_(opt)
         clip_grad_norm_(model.parameters(), 5)
 
-        opt.step()
+        scaler.step(opt)
+        scaler.update()
         # print(temp.item())
     return losses, grads
 
@@ -339,13 +393,16 @@ if __name__ == "__main__":
         best_auc = 0
         pat = PAT
 
+        # loss scaling is needed only by float16, bfloat16 has the same range as float32
+        scaler = torch.amp.GradScaler(DEVICE, enabled=AMP and AMP_DTYPE == torch.float16)
+
         grads = None
         for epoch in range(EPOCHS):
 
             print(f"Epoch {epoch}")
 
             losses, grads = train_loop(
-                model, train_dataloader, opt, grads, WEIGHT, LT, LOG, LOG_EVERY
+                model, train_dataloader, opt, grads, WEIGHT, LT, LOG, LOG_EVERY, scaler
             )
             roc_auc, pr_auc, val_losses = eval_auc_loop(model, val_dataloader, WEIGHT)
 
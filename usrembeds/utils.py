@@ -1,22 +1,29 @@
 import datetime
+import numpy as np
 import torch
 from datautils.dataset import MusicDataset
-from sklearn.manifold import TSNE
 import matplotlib.pyplot as plt
+
+try:
+    # multi-threaded t-SNE, much faster than the single-threaded one of scikit-learn
+    from openTSNE import TSNE
+except ImportError:
+    TSNE = None
+    from sklearn.manifold import TSNE as SklearnTSNE
 import argparse
 
 
-def plot_music_batch(emb, device):
+def plot_music_batch(emb):
 
     emb_flat = emb.view(-1, emb.shape[2])  # flatten the first two dimensions
-    tsne = TSNE(n_components=2)
-
-    emb_2d = tsne.fit_transform(emb_flat.cpu().detach().numpy())
-    emb_2d = torch.tensor(emb_2d, device=device).view(
-        emb.shape[0], emb.shape[1], 2
-    )  # reshape back to [16, 6, 2]
-
-    emb_2d_np = emb_2d.cpu().detach().numpy()
+    emb_flat = emb_flat.cpu().detach().numpy()
+
+    if TSNE is not None:
+        emb_2d = TSNE(n_components=2, n_jobs=-1).fit(emb_flat)
+    else:
+        emb_2d = SklearnTSNE(n_components=2).fit_transform(emb_flat)
+    # reshape back to [16, 6, 2], the points are only plotted so they stay on the cpu
+    emb_2d_np = np.asarray(emb_2d).reshape(emb.shape[0], emb.shape[1], 2)
 
     plt.figure(figsize=(10, 8))
     for i in range(emb_2d_np.shape[0]):
@@ -524,6 +524,7 @@ def main(
                 f"Failed to generate music for prompt '{prompt}' in genre '{genre}': {e}"
             )
 
+    gen.flush()
     print("Done generating. Now embedding them with MERT...")
 
     # -----------------------